@@ -19,12 +19,15 @@ DOCUMENTATION = r'''
 module: json_patch
 author: "Joey Espinosa (@ParticleDecay)"
 short_description: Patch JSON documents
-requirements: []
+requirements:
+    - fastjsonschema or jsonschema, when I(schema) is set
 version_added: "2.10"
 description:
     - Patch JSON documents using JSON Patch standard
     - "RFC 6901: https://tools.ietf.org/html/rfc6901"
     - "RFC 6902: https://tools.ietf.org/html/rfc6902"
+    - "Also usable without Ansible, e.g. in container entrypoints: C(python json_patch.py apply --help)"
+    - "C(python json_patch.py watch <config>) keeps files patched, re-applying operations when they drift (inotify)"
 options:
     src:
         description:
@@ -46,6 +49,19 @@ options:
             - Copy the targeted file to a backup prior to patch
         required: False
         type: bool
+    backup_store:
+        description:
+            - Keep backups in this directory as a deduplicated, content-addressed store instead of full copies next to the file
+            - New content is reflinked when the filesystem allows it, otherwise stored as a compressed delta
+            - Compressed backups (C(.z) for full copies, C(.delta) for deltas) are restored with C(python json_patch.py restore <backup> [dest])
+        required: False
+        type: str
+    backup_retention:
+        description:
+            - Number of backups per file to keep in backup_store
+        required: False
+        default: 10
+        type: int
     unsafe_writes:
         description:
             - Allow Ansible to fall back to unsafe methods of writing files (some systems do not support atomic operations)
@@ -70,6 +86,48 @@ options:
             - "array"
         default: "object"
         type: str
+    cas_retries:
+        description:
+            - How often to re-read and re-apply the operations when the source changed while it was being patched
+            - The source's inode, mtime and content hash are recorded when reading and verified before the result is renamed into place
+        required: False
+        default: 3
+        type: int
+    compact:
+        description:
+            - Parse the document in a memory-compact mode that shares repeated keys and short strings
+            - Useful for large inventory- or state-style documents made of many similar objects
+        required: False
+        default: False
+        type: bool
+    metrics_pushgateway:
+        description:
+            - URL of a Prometheus Pushgateway to push run metrics (durations, file sizes, changed counts) to
+            - Metrics are only collected when this or metrics_textfile is set
+            - Counters and histograms are cumulative per dest and host, kept below C(~/.cache/json_patch/metrics) (or C($XDG_CACHE_HOME))
+        required: False
+        type: str
+    metrics_textfile:
+        description:
+            - Path of a node-exporter textfile (C(.prom)) or directory to write run metrics to
+            - In a directory every dest gets a file of its own, with a C(dest) label on its metrics
+            - Used when metrics_pushgateway is unset or cannot be reached
+        required: False
+        type: str
+    schema:
+        description:
+            - JSON Schema the patched document must match before it is written, as a dict or the path of a JSON file on the target
+            - Uses fastjsonschema when available, otherwise jsonschema
+            - Documents of 1 MiB or more are only validated along the paths touched by the operations, unless the schema uses references or combinators
+        required: False
+        type: raw
+    schema_cache:
+        description:
+            - Directory for schemas compiled by fastjsonschema, keyed by the schema's hash
+            - Defaults to C(~/.cache/json_patch/schemas) (or below C($XDG_CACHE_HOME))
+            - Compiled code is only loaded when the directory is owned by the user running the module and not writable by others
+        required: False
+        type: str
 '''
 
 
@@ -151,6 +209,15 @@ EXAMPLES = r'''
       - op: test
         path: "/0/foo/three"
         value: 3
+
+- name: enable live restore, refusing to write a daemon.json docker would reject
+  json_patch:
+    src: "/etc/docker/daemon.json"
+    schema: "/etc/docker/daemon.schema.json"
+    operations:
+      - op: add
+        path: "/live-restore"
+        value: true
 '''
 
 
@@ -175,19 +242,36 @@ created:
     description: whether the file was newly created
     returned: always
     type: bool
+conflicts:
+    description: how often the source changed concurrently and the operations were re-applied
+    returned: when the source changed while being patched
+    type: int
 '''
 
 
+import base64
+import copy
+import hashlib
 import json
 import os
+import re
+import sys
 import tempfile
+import time
+import zlib
+from contextlib import contextmanager
 
-from ansible.module_utils import basic
-from ansible.module_utils.common.text.converters import to_bytes, to_native
+# Ansible itself and the schema libraries are imported lazily (see main() and
+# SchemaValidator), so that the standalone `apply` command and patch_file()
+# start without loading them.
+CLI_COMMANDS = ('apply', 'restore', 'watch')
 
 
 def set_module_args(args):
     """For dynamic module args (such as for testing)."""
+    from ansible.module_utils import basic
+    from ansible.module_utils.common.text.converters import to_bytes
+
     args = json.dumps({'ANSIBLE_MODULE_ARGS': args})
     basic._ANSIBLE_ARGS = to_bytes(args)
 
@@ -197,21 +281,653 @@ class PathError(Exception):
     pass
 
 
+class ConflictError(Exception):
+    """Raised when the source file changed between reading and writing it."""
+    pass
+
+
+class SchemaError(Exception):
+    """Raised when a patched document does not match its JSON Schema."""
+    pass
+
+
+METRICS_STATE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'json_patch', 'metrics')
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+_LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def parse_exposition(text):
+    """Parse Prometheus text into `{name: [type, help, {(sample, labels): value}]}`; labels stay escaped."""
+    families, family = {}, None
+    for line in text.splitlines():
+        if line.startswith('# HELP ') or line.startswith('# TYPE '):
+            name, _, rest = line[7:].partition(' ')
+            family = families.setdefault(name, [None, '', {}])
+            family[0 if line[2] == 'T' else 1] = rest
+        elif line and not line.startswith('#') and family is not None:
+            match = _SAMPLE.match(line)
+            if match:
+                family[2][(match.group(1), tuple(_LABEL.findall(match.group(2) or '')))] = float(match.group(3))
+    return families
+
+
+def merge_exposition(totals, run):
+    """Add the samples of `run` to `totals`: counters and histograms accumulate, gauges are replaced."""
+    for name, (metric_type, help_text, samples) in run.items():
+        family = totals.setdefault(name, [metric_type, help_text, {}])
+        family[0], family[1] = metric_type, help_text
+        for key, value in samples.items():
+            family[2][key] = value if metric_type == 'gauge' else family[2].get(key, 0) + value
+    return totals
+
+
+def render_exposition(families, labels=()):
+    """Render parsed families, with the (already escaped) `labels` added to every sample."""
+    lines = []
+    for name, (metric_type, help_text, samples) in families.items():
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for (sample, sample_labels), value in samples.items():
+            pairs = tuple(labels) + sample_labels
+            lines.append('%s%s %s' % (sample, '{%s}' % ','.join('%s="%s"' % pair for pair in pairs) if pairs else '',
+                                      '%d' % value if value == int(value) else repr(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics(object):
+    """Collect Prometheus metrics for one module run.
+
+    The text exposition format is rendered by hand so the module keeps working
+    on hosts without prometheus_client. flush() adds the run to the totals
+    kept in `state_dir` for its grouping (the dest and the host), so
+    counters and histograms are cumulative across runs, and pushes those to
+    a Pushgateway, or writes them to a node-exporter textfile of their own
+    when the gateway is unset or down.
+    """
+
+    enabled = True
+    BUCKETS = {
+        'seconds': (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+        'bytes': (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864),
+    }
+
+    def __init__(self, job, pushgateway=None, textfile=None, grouping=None, state_dir=None):
+        import socket
+
+        self.job = job
+        self.pushgateway = pushgateway
+        self.textfile = textfile
+        self.grouping = dict(grouping or {})
+        self.grouping.setdefault('instance', socket.gethostname())  # hosts patching the same dest stay apart
+        self.state_dir = state_dir or METRICS_STATE
+        self._meta = {}  # name -> (type, help)
+        self._series = {}  # name -> {labels: value or [bucket counts..., sum, count]}
+
+    def _get(self, name, metric_type, help_text):
+        if name not in self._meta:
+            self._meta[name] = (metric_type, help_text)
+            self._series[name] = {}
+        return self._series[name]
+
+    def inc(self, name, help_text, labels=None, value=1):
+        series = self._get(name, 'counter', help_text)
+        key = tuple(sorted((labels or {}).items()))
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, help_text, value, labels=None):
+        self._get(name, 'gauge', help_text)[tuple(sorted((labels or {}).items()))] = value
+
+    def observe(self, name, help_text, value, labels=None):
+        series = self._get(name, 'histogram', help_text)
+        buckets = self.BUCKETS[name.rsplit('_', 1)[-1]]
+        key = tuple(sorted((labels or {}).items()))
+        hist = series.setdefault(key, [0] * len(buckets) + [0, 0])
+        for idx, bound in enumerate(buckets):
+            if value <= bound:
+                hist[idx] += 1
+        hist[-2] += value
+        hist[-1] += 1
+
+    @contextmanager
+    def time(self, name, help_text, labels=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, help_text, time.perf_counter() - start, labels)
+
+    def render(self):
+        def fmt(labels):
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for k, v in labels)
+
+        lines = []
+        for name, (metric_type, help_text) in self._meta.items():
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in self._series[name].items():
+                if metric_type == 'histogram':
+                    buckets = self.BUCKETS[name.rsplit('_', 1)[-1]]
+                    for bound, count in zip(buckets, value):
+                        lines.append('%s_bucket%s %d' % (name, fmt(labels + (('le', repr(bound)),)), count))
+                    lines.append('%s_bucket%s %d' % (name, fmt(labels + (('le', '+Inf'),)), value[-1]))
+                    lines.append('%s_sum%s %r' % (name, fmt(labels), value[-2]))
+                    lines.append('%s_count%s %d' % (name, fmt(labels), value[-1]))
+                else:
+                    lines.append('%s%s %r' % (name, fmt(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """Add this run to the totals of its group and push or write them. Returns an error message or None."""
+        import fcntl
+        from urllib.request import Request, urlopen  # only paid for when metrics are enabled
+
+        group = '%s-%s.prom' % (self.job, hashlib.sha256(
+            json.dumps(sorted(self.grouping.items())).encode('utf-8')).hexdigest()[:16])
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        state = os.path.join(self.state_dir, group)
+        with open(os.path.join(self.state_dir, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            totals = {}
+            if os.path.exists(state):
+                with open(state) as f:
+                    totals = parse_exposition(f.read())
+            totals = merge_exposition(totals, parse_exposition(self.render()))
+            payload = render_exposition(totals)
+            self._write(state, payload)
+
+        error = None
+        textfile = self.textfile
+        if textfile and not textfile.endswith('.prom'):
+            textfile = os.path.join(textfile, group)
+        if self.pushgateway:
+            url = '%s/metrics/job/%s' % (self.pushgateway.rstrip('/'), self.job)
+            for key, value in sorted(self.grouping.items()):
+                encoded = base64.urlsafe_b64encode(str(value).encode('utf-8')).decode('ascii').rstrip('=') or '='
+                url += '/%s@base64/%s' % (key, encoded)
+            try:
+                request = Request(url, data=payload.encode('utf-8'), method='POST',
+                                  headers={'Content-Type': 'text/plain; version=0.0.4'})
+                with urlopen(request, timeout=5):
+                    pass
+                if textfile and os.path.exists(textfile):  # a fallback file would be counted twice
+                    os.unlink(textfile)
+                return None
+            except (OSError, ValueError) as e:
+                error = "could not push metrics to `%s`: %s" % (self.pushgateway, e)
+        if textfile:
+            # node-exporter sets `instance` itself
+            labels = [(k, _escape_label(v)) for k, v in sorted(self.grouping.items()) if k != 'instance']
+            self._write(textfile, render_exposition(totals, labels))
+        return error
+
+    @staticmethod
+    def _write(path, text):
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(tmpfile, 0o644)
+        os.rename(tmpfile, path)
+
+
+class NullMetrics(object):
+    """Used when metrics are disabled; every call is a no-op."""
+
+    enabled = False
+
+    def inc(self, *args, **kwargs):
+        pass
+
+    def set(self, *args, **kwargs):
+        pass
+
+    def observe(self, *args, **kwargs):
+        pass
+
+    def time(self, *args, **kwargs):
+        return _NULL_TIMER
+
+    def flush(self):
+        return None
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+DURATION = 'json_patch_duration_seconds', 'Time spent per phase of a json_patch run'
+FILE_SIZE = 'json_patch_file_size_bytes', 'Size of the JSON document before and after patching'
+RUNS = 'json_patch_runs_total', 'json_patch runs by outcome'
+OPERATIONS = 'json_patch_operations_total', 'Patch operations of completed runs by op and whether the run changed the file'
+CONFLICTS = 'json_patch_conflicts_total', 'Writes retried because the source changed concurrently'
+LAST_RUN = 'json_patch_last_run_timestamp_seconds', 'When json_patch last completed a run'
+
+
+class BackupStore(object):
+    """Content-addressed, deduplicated store for backups of patched files.
+
+    Each distinct file content is stored once, under its sha256, and every
+    backup is a name hard-linked to that object. New content is stored as a
+    reflink clone of the file where the filesystem supports it (a private
+    copy-on-write inode, hashed after cloning), otherwise as a zlib-compressed
+    full copy or delta against the previous backup of the same file. Never as
+    a link to the file itself: services rewrite their files in place. Objects
+    are written under a temporary name and renamed, and whatever a failed
+    backup created is removed again, so an interrupted run leaves nothing in
+    the way. Only the newest `retention` backups per file are kept; objects
+    nobody needs are removed.
+
+    Backup names follow backup_local(), `<file>.<serial>.<timestamp>~`, with
+    the suffix of their object: `.z` for a zlib-compressed copy, `.delta` for
+    a delta that only restore can rebuild. When a delta is rewritten in full
+    its name changes suffix; restore accepts either. Restore with
+    `python json_patch.py restore <backup> [dest]`.
+    """
+
+    FICLONE = 0x40049409  # linux/fs.h
+    SUFFIXES = {'file': '', 'zfull': '.z', 'delta': '.delta'}
+
+    def __init__(self, root, retention=10):
+        self.root = root
+        self.retention = retention
+        self.index_path = os.path.join(root, 'index.json')
+
+    @contextmanager
+    def _locked(self):
+        import fcntl
+
+        for sub in ('objects', 'names'):
+            if not os.path.isdir(os.path.join(self.root, sub)):
+                os.makedirs(os.path.join(self.root, sub))
+        with open(os.path.join(self.root, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.index_path):
+                with open(self.index_path) as f:
+                    index = json.load(f)
+            else:
+                index = {'objects': {}, 'files': {}}
+            # files to remove if the index recording the change is not written, and once it is
+            self._created, self._obsolete = [], []
+            try:
+                yield index
+                # not write_atomic(): its commit_lock() must never be taken while holding `.lock`
+                fd, tmpfile = tempfile.mkstemp(dir=self.root, prefix='.index.')
+                self._created.append(tmpfile)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(json.dumps(index))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmpfile, self.index_path)
+            except BaseException:
+                self._remove(self._created)
+                raise
+            self._remove(self._obsolete)
+
+    @staticmethod
+    def _remove(paths):
+        for path in paths:
+            if os.path.lexists(path):
+                os.unlink(path)
+
+    def _object_path(self, sha, kind):
+        return os.path.join(self.root, 'objects', sha + self.SUFFIXES[kind])
+
+    @staticmethod
+    def _tokens(data):
+        # split after commas: stable boundaries for JSON, even when minified
+        return re.split(b'(?<=,)', data)
+
+    def read(self, sha, index):
+        """Return the content of object `sha`, resolving delta chains."""
+        meta = index['objects'][sha]
+        with open(self._object_path(sha, meta['kind']), 'rb') as f:
+            data = f.read()
+        if meta['kind'] == 'zfull':
+            return zlib.decompress(data)
+        if meta['kind'] == 'delta':
+            base = self._tokens(self.read(meta['base'], index))
+            parts = []
+            for piece in json.loads(zlib.decompress(data).decode('utf-8')):
+                if isinstance(piece, list):
+                    parts.extend(base[piece[0]:piece[1]])
+                else:
+                    parts.append(piece.encode('utf-8', 'surrogateescape'))
+            return b''.join(parts)
+        return data
+
+    def _clone(self, path):
+        """Return a temporary reflink clone of `path` in the store, or None if unsupported."""
+        import fcntl
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, 'objects'), prefix='.tmp-')
+        self._created.append(tmp)
+        try:
+            with open(path, 'rb') as src:
+                fcntl.ioctl(fd, self.FICLONE, src.fileno())
+            return tmp
+        except (IOError, OSError):
+            os.unlink(tmp)
+            return None
+        finally:
+            os.close(fd)
+
+    def _write_delta(self, sha, data, base_data):
+        from difflib import SequenceMatcher
+
+        base_tokens, tokens = self._tokens(base_data), self._tokens(data)
+        pieces = []
+        matcher = SequenceMatcher(None, base_tokens, tokens)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                pieces.append([i1, i2])
+            elif j2 > j1:
+                pieces.append(b''.join(tokens[j1:j2]).decode('utf-8', 'surrogateescape'))
+        self._write_object(self._object_path(sha, 'delta'),
+                           zlib.compress(json.dumps(pieces).encode('utf-8', 'surrogateescape'), 9))
+
+    def _write_object(self, path, data):
+        # mkstemp creates files 0600: backed up files may hold credentials (auth.json)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        self._created.append(tmp)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        self._install(tmp, path)
+
+    def _install(self, tmp, path):
+        self._created.append(path)
+        os.rename(tmp, path)
+
+    def _link(self, target, name):
+        self._remove([name])  # left over by an interrupted run
+        self._created.append(name)
+        os.link(target, name)
+
+    def backup(self, path):
+        """Back up `path`; return the backup name, or '' if `path` does not exist."""
+        if not os.path.exists(path):
+            return ''
+        path = os.path.realpath(path)
+        with self._locked() as index:
+            clone = self._clone(path)
+            with open(clone or path, 'rb') as f:  # hash the clone: `path` may change meanwhile
+                data = f.read()
+            sha = hashlib.sha256(data).hexdigest()
+            history = index['files'].setdefault(path, [])
+            if sha in index['objects']:
+                if clone:
+                    os.unlink(clone)
+            else:
+                base = history[-1]['sha'] if history else None
+                if clone:
+                    self._install(clone, self._object_path(sha, 'file'))
+                    kind = 'file'
+                elif base is None:
+                    self._write_object(self._object_path(sha, 'zfull'), zlib.compress(data, 9))
+                    kind = 'zfull'
+                else:
+                    self._write_delta(sha, data, self.read(base, index))
+                    kind = 'delta'
+                index['objects'][sha] = {'kind': kind, 'base': base if kind == 'delta' else None}
+            kind = index['objects'][sha]['kind']
+            index['serial'] = index.get('serial', 0) + 1
+            stamp = time.strftime("%Y-%m-%d@%H:%M:%S", time.localtime())
+            name = os.path.join(self.root, 'names', '%s.%d.%s~%s' % (
+                os.path.basename(path), index['serial'], stamp, self.SUFFIXES[kind]))
+            self._link(self._object_path(sha, kind), name)
+            history.append({'sha': sha, 'name': name, 'time': time.time()})
+            self._expire(index, path)
+        return name
+
+    def _expire(self, index, path):
+        history = index['files'][path]
+        expired, index['files'][path] = history[:-self.retention], history[-self.retention:]
+        self._obsolete.extend(entry['name'] for entry in expired)
+        # the oldest kept delta may have lost its base: rewrite it in full
+        kept = set(entry['sha'] for entries in index['files'].values() for entry in entries)
+        for sha in kept:
+            meta = index['objects'][sha]
+            if meta['kind'] == 'delta' and meta['base'] not in kept:
+                data = self.read(sha, index)
+                self._write_object(self._object_path(sha, 'zfull'), zlib.compress(data, 9))
+                for entries in index['files'].values():
+                    for entry in entries:
+                        if entry['sha'] == sha:  # same serial and stamp, the suffix of the new object
+                            name = self._stem(entry['name']) + self.SUFFIXES['zfull']
+                            self._link(self._object_path(sha, 'zfull'), name)
+                            self._obsolete.append(entry['name'])
+                            entry['name'] = name
+                self._obsolete.append(self._object_path(sha, 'delta'))
+                index['objects'][sha] = {'kind': 'zfull', 'base': None}
+        for sha in [sha for sha in index['objects'] if sha not in kept]:
+            meta = index['objects'].pop(sha)
+            self._obsolete.append(self._object_path(sha, meta['kind']))
+
+    @staticmethod
+    def _stem(name):
+        return name.rsplit('~', 1)[0] + '~'
+
+    def restore(self, name, dest=None):
+        """Write the content of backup `name` to `dest` (default: the backed up file)."""
+        stem = self._stem(os.path.abspath(name))
+        found = None
+        with self._locked() as index:
+            for path, entries in index['files'].items():
+                for entry in entries:
+                    if self._stem(entry['name']) == stem:
+                        found = dest or path, self.read(entry['sha'], index)
+        if found is None:
+            raise IOError("`%s` is not a backup in `%s`" % (name, self.root))
+        # outside `.lock`: writers take commit_lock() first and `.lock` second, never the other way round
+        write_atomic(found[0], found[1].decode('utf-8', 'surrogateescape'))
+        return found[0]
+
+
+SCHEMA_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'json_patch', 'schemas')
+SCHEMA_SUBTREE_SIZE = 1 << 20  # documents from this size on are validated per touched subtree
+SCHEMA_REF = re.compile(r'"\$(?:ref|dynamicRef|recursiveRef)"')
+
+
+class SchemaValidator(object):
+    """Validate patched documents against a JSON Schema.
+
+    With fastjsonschema, every (sub)schema is compiled to Python source once
+    and kept in `cache_dir` under the sha256 of its canonical JSON; later runs
+    import it from there (bytecode included) instead of generating it again.
+    Code is only loaded from a cache directory and file owned by the current
+    user and writable by nobody else; otherwise schemas are compiled in
+    memory. Without fastjsonschema, jsonschema is used, whose validators are
+    only kept in memory.
+
+    validate() checks documents of at least `subtree_size` bytes per touched
+    subtree only: the value at each operation's path against its subschema,
+    and every ancestor against its own keywords (type, required, sizes, ...)
+    but not its children. Schemas whose structure cannot be followed along a
+    path ($ref, combinators, conditionals, pattern or tuple items) fall back
+    to validating the whole document.
+    """
+
+    # keywords after which a subschema no longer follows from the path alone
+    NON_LOCAL = ('$ref', '$dynamicRef', '$recursiveRef', 'allOf', 'anyOf', 'oneOf', 'not', 'if',
+                 'dependencies', 'dependentSchemas', 'patternProperties', 'unevaluatedProperties',
+                 'unevaluatedItems', 'contains', 'prefixItems', 'additionalItems')
+    _compiled = {}  # validators shared by all instances of this process, by schema digest
+
+    def __init__(self, schema, cache_dir=None, subtree_size=SCHEMA_SUBTREE_SIZE):
+        try:
+            import fastjsonschema as backend
+        except ImportError:
+            try:
+                import jsonschema as backend
+                import jsonschema.exceptions  # noqa: F401
+                import jsonschema.validators  # noqa: F401
+            except ImportError:
+                raise ImportError("schema validation requires the fastjsonschema or jsonschema library")
+        self.backend = backend
+        if not isinstance(schema, dict):
+            with open(schema) as f:
+                schema = json.load(f)
+        self.schema = schema
+        self.cache_dir = cache_dir or SCHEMA_CACHE
+        self.subtree_size = subtree_size
+
+    def compile(self, schema):
+        """Return a callable `(instance, name)` raising SchemaError for `schema`."""
+        fast = self.backend.__name__ == 'fastjsonschema'
+        backend = 'fastjsonschema-%s' % self.backend.VERSION if fast else 'jsonschema'
+        digest = hashlib.sha256(('%s\n%s' % (backend, json.dumps(schema, sort_keys=True))).encode()).hexdigest()
+        if digest not in self._compiled:
+            if fast:
+                self._compiled[digest] = self._load_fast(schema, digest)
+            else:
+                self._compiled[digest] = self._load_jsonschema(schema)
+        return self._compiled[digest]
+
+    @staticmethod
+    def _private(path):
+        """Whether `path` belongs to the current user and nobody else can write to it."""
+        import stat
+
+        st = os.lstat(path)
+        return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+    def _load_fast(self, schema, digest):
+        import importlib.util
+
+        fastjsonschema = self.backend
+        path = os.path.join(self.cache_dir, 'schema_%s.py' % digest[:40])
+        bytecode_dir = os.path.join(self.cache_dir, '__pycache__')
+        if not os.path.isdir(bytecode_dir):
+            os.makedirs(bytecode_dir, 0o700)
+        if not (self._private(self.cache_dir) and self._private(bytecode_dir)):
+            check = fastjsonschema.compile(schema)  # whoever can write there could run code as us
+        else:
+            if not os.path.exists(path) or not self._private(path):
+                fd, tmpfile = tempfile.mkstemp(dir=self.cache_dir, prefix='.schema_')  # 0600, never via a symlink
+                with os.fdopen(fd, 'w') as f:
+                    f.write(fastjsonschema.compile_to_code(schema))
+                os.rename(tmpfile, path)
+            spec = importlib.util.spec_from_file_location('json_patch_schema_%s' % digest[:40], path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            check = module.validate
+
+        def validate(instance, name):
+            try:
+                check(instance, name_prefix=name)
+            except fastjsonschema.JsonSchemaValueException as e:
+                raise SchemaError(e.message)
+        return validate
+
+    def _load_jsonschema(self, schema):
+        jsonschema = self.backend
+        cls = jsonschema.validators.validator_for(schema)
+        cls.check_schema(schema)
+        validator = cls(schema)
+
+        def validate(instance, name):
+            error = jsonschema.exceptions.best_match(validator.iter_errors(instance))
+            if error is not None:
+                location = ''.join('[%r]' % elem if isinstance(elem, int) else '.%s' % elem
+                                   for elem in error.absolute_path)
+                raise SchemaError('%s%s: %s' % (name, location, error.message))
+        return validate
+
+    def validate(self, obj, operations=(), size=0):
+        """Raise SchemaError unless `obj`, the result of `operations`, matches the schema."""
+        checks = None
+        if size >= self.subtree_size and operations:
+            checks = self.subtree_checks(obj, operations)
+        if checks is None:
+            checks = [(obj, self.schema, 'data')]
+        for instance, schema, name in checks:
+            self.compile(schema)(instance, name)
+
+    def subtree_checks(self, obj, operations):
+        """Return `(instance, schema, name)` triples covering the touched subtrees, or None."""
+        checks = {}
+        for op in operations:
+            for key in ('path', 'from'):
+                if key not in op:
+                    continue
+                elements = [elem for elem in op[key].lstrip('/').split('/') if elem]
+                touched = self._walk(obj, elements)
+                if touched is None:
+                    return None
+                for instance, schema, name in touched:
+                    checks[(name, json.dumps(schema, sort_keys=True))] = (instance, schema, name)
+        return [checks[key] for key in sorted(checks)]
+
+    def _walk(self, obj, elements):
+        """Return the checks for one operation path, or None if the schema cannot be followed."""
+        touched = []
+        node, schema, name = obj, self.schema, 'data'
+        for elem in elements:
+            if schema is True or schema == {}:
+                return touched  # nothing constrains this subtree
+            if not isinstance(schema, dict) or any(keyword in schema for keyword in self.NON_LOCAL):
+                return None
+            if isinstance(node, dict) and elem in node:
+                child, child_name = node[elem], '%s.%s' % (name, elem)
+                sub = schema.get('properties', {}).get(elem, schema.get('additionalProperties', True))
+            elif isinstance(node, list) and elem.isdigit() and int(elem) < len(node):
+                child, child_name = node[int(elem)], '%s[%s]' % (name, elem)
+                sub = schema.get('items', True)
+            else:  # removed, appended (-) or wildcard (*): the container itself changed
+                break
+            touched.append((node, self._standalone(self._shallow(schema)), name))
+            node, schema, name = child, sub, child_name
+        if schema is True:
+            return touched
+        if not isinstance(schema, dict) or SCHEMA_REF.search(json.dumps(schema)):
+            return None  # false, tuple items or references that only resolve in the root schema
+        touched.append((node, self._standalone(schema), name))
+        return touched
+
+    def _standalone(self, schema):
+        if '$schema' in self.schema and '$schema' not in schema:
+            schema = dict(schema, **{'$schema': self.schema['$schema']})
+        return schema
+
+    @staticmethod
+    def _shallow(schema):
+        """`schema` without constraints on child values."""
+        shallow = dict(schema)
+        if 'properties' in shallow:
+            shallow['properties'] = dict((key, {}) for key in shallow['properties'])
+        if isinstance(shallow.get('additionalProperties'), dict):
+            shallow['additionalProperties'] = {}
+        shallow.pop('items', None)
+        return shallow
+
+
 class PatchManager(object):
     """Manage the Ansible portion of JSONPatcher."""
 
     def __init__(self, module):
         self.module = module
+        pushgateway = self.module.params.get('metrics_pushgateway')
+        textfile = self.module.params.get('metrics_textfile')
+        if pushgateway or textfile:
+            self.metrics = Metrics('json_patch', pushgateway, textfile,
+                                   grouping={'dest': self.module.params.get('dest') or self.module.params['src']})
+        else:
+            self.metrics = NullMetrics()
         self.create = self.module.params.get('create', False)
         self.create_type = self.module.params.get('create_type', 'object').lower()
-        empty = False
-
-        # validate file
         self.src = self.module.params['src']
-        if not os.path.isfile(self.src):
-            if not self.create:
-                self.module.fail_json(msg="could not find file at `%s`" % self.src)
-            empty = True
 
         # use 'src' as the output file, unless 'dest' is provided
         self.outfile = self.src
@@ -219,82 +935,166 @@ class PatchManager(object):
         if self.dest is not None:
             self.outfile = self.dest
 
-        try:
-            self.json_doc = open(self.src).read() if not empty else ""
-        except IOError:
-            self.module.fail_json(msg="could not read file at `%s`" % self.src)
-
-        # create empty JSON if requested
-        if self.json_doc == "" and self.create:
-            if self.create_type == "object":
-                self.json_doc = "{}"
-            elif self.create_type == "array":
-                self.json_doc = "[]"
-            else:
-                self.module.fail_json(msg="invalid option for 'create_type': %s" % self.create_type)
-
         self.operations = self.module.params['operations']
-        try:
-            self.patcher = JSONPatcher(self.json_doc, *self.operations)
-        except Exception as e:
-            self.module.fail_json(msg=str(e))
+        self.load()
+        if self.metrics.enabled:  # encoding the whole document is not free
+            self.metrics.observe(*FILE_SIZE, value=len(self.json_doc.encode('utf-8', 'surrogateescape')),
+                                 labels={'stage': 'before'})
 
         self.do_backup = self.module.params.get('backup', False)
         self.pretty_print = self.module.params.get('pretty', False)
 
-    def run(self):
-        changed, tested = self.patcher.patch()
-        result = {'changed': changed}
-        if tested is not None:
-            result['tested'] = tested
-        if result['changed']:  # let's write the changes
-            dump_kwargs = {}
-            if self.pretty_print:
-                dump_kwargs.update({'indent': 4, 'separators': (',', ': ')})
+        self.validator = None
+        if self.module.params.get('schema') is not None:
+            try:
+                self.validator = SchemaValidator(self.module.params['schema'], self.module.params.get('schema_cache'))
+            except ImportError as e:
+                from ansible.module_utils.basic import missing_required_lib
+                self.module.fail_json(msg=missing_required_lib('fastjsonschema or jsonschema'), exception=str(e))
+            except (IOError, ValueError) as e:
+                self.module.fail_json(msg="cannot load schema: %s" % e)
+
+    def load(self):
+        """(Re-)read 'src' and prepare a patcher for a fresh copy of the operations."""
+        try:
+            self.json_doc, self.src_state = read_document(self.src, self.create, self.create_type)
+        except (IOError, ValueError) as e:
+            self.module.fail_json(msg=str(e))
+        try:
+            with self.metrics.time(*DURATION, labels={'phase': 'parse'}):
+                self.patcher = JSONPatcher(self.json_doc, *copy.deepcopy(self.operations),
+                                           compact=self.module.params.get('compact', False))
+        except Exception as e:
+            self.module.fail_json(msg=str(e))
 
+    def run(self):
+        retries = self.module.params.get('cas_retries', 3)
+        conflicts = 0
+        while True:
+            with self.metrics.time(*DURATION, labels={'phase': 'patch'}):
+                changed, tested = self.patcher.patch()
+            result = {'changed': changed}
+            if tested is not None:
+                result['tested'] = tested
+            if not result['changed']:
+                break
+            # let's write the changes
             result['diff'] = dict(
                 before=self.json_doc,
-                after=json.dumps(self.patcher.obj, **dump_kwargs),
+                after=json.dumps(self.patcher.obj, **dump_kwargs(self.pretty_print)),
                 before_header='%s (content)' % self.module.params['src'],
                 after_header='%s (content)' % self.module.params['src'],
             )
-            result.update(self.write())
+            try:
+                with self.metrics.time(*DURATION, labels={'phase': 'write'}):
+                    result.update(self.write())
+            except ConflictError as e:  # somebody else wrote 'src': re-apply on top of their change
+                conflicts += 1
+                self.metrics.inc(*CONFLICTS)
+                if conflicts > retries:
+                    self.module.fail_json(msg="%s, gave up after %d retries" % (e, retries))
+                self.load()
+                continue
+            if self.metrics.enabled:
+                self.metrics.observe(*FILE_SIZE, value=len(result['diff']['after'].encode('utf-8', 'surrogateescape')),
+                                     labels={'stage': 'after'})
+            break
+        changed = str(bool(result['changed'])).lower()
+        self.metrics.inc(*RUNS, labels={'changed': changed})
+        self.metrics.set(*LAST_RUN, time.time())
+        for op in self.operations:
+            self.metrics.inc(*OPERATIONS, labels={'op': op.get('op'), 'changed': changed})
+        if conflicts:
+            result['conflicts'] = conflicts
         return result
 
+    def flush_metrics(self):
+        error = self.metrics.flush()
+        if error:
+            self.module.warn(error)
+
     def backup(self):
         """Create a backup copy of the JSON file."""
+        store = self.module.params.get('backup_store')
+        if store:
+            backups = BackupStore(store, self.module.params.get('backup_retention') or 10)
+            return {'backup': backups.backup(self.outfile)}
         return {'backup': self.module.backup_local(self.outfile)}
 
+    def validate(self):
+        """Fail unless the patched document matches the schema, if one is given."""
+        if self.validator is None:
+            return
+        try:
+            with self.metrics.time(*DURATION, labels={'phase': 'validate'}):
+                self.validator.validate(self.patcher.obj, self.operations, size=len(self.json_doc))
+        except SchemaError as e:
+            self.module.fail_json(msg="patched `%s` does not match the schema: %s" % (self.src, e))
+        except Exception as e:  # an invalid schema
+            self.module.fail_json(msg="cannot validate against the schema: %s" % e)
+
     def write(self):
+        from ansible.module_utils.common.text.converters import to_bytes, to_native
+
         result = {'dest': self.outfile}
+        self.validate()
 
         if self.module.check_mode:  # stop here before doing anything permanent
             return result
 
-        dump_kwargs = {}
-        if self.pretty_print:
-            dump_kwargs.update({'indent': 4, 'separators': (',', ': ')})
-
-        if self.do_backup:  # backup first if needed
-            result.update(self.backup())
-
         _, tmpfile = tempfile.mkstemp()
         with open(tmpfile, "w") as f:
-            f.write(json.dumps(self.patcher.obj, **dump_kwargs))
-
-        self.module.atomic_move(tmpfile,
-                                to_native(os.path.realpath(to_bytes(self.outfile, errors='surrogate_or_strict')), errors='surrogate_or_strict'),
-                                unsafe_writes=self.module.params['unsafe_writes'])
+            f.write(json.dumps(self.patcher.obj, **dump_kwargs(self.pretty_print)))
+
+        with commit_lock(self.outfile):
+            if not unchanged_since(self.src, self.src_state):
+                os.unlink(tmpfile)
+                raise ConflictError("`%s` was modified while it was being patched" % self.src)
+            if self.do_backup:  # back up exactly what is replaced, once the write can no longer conflict
+                result.update(self.backup())
+            self.module.atomic_move(tmpfile,
+                                    to_native(os.path.realpath(to_bytes(self.outfile, errors='surrogate_or_strict')), errors='surrogate_or_strict'),
+                                    unsafe_writes=self.module.params['unsafe_writes'])
 
         return result
 
 
+def compact_loads(json_doc, max_length=64):
+    """Parse `json_doc` sharing one object per distinct key and short string.
+
+    The json scanner already reuses key objects, but never values. In
+    documents made of many similar objects (inventories, state files) the same
+    short strings repeat in every element, so keeping a single copy of each
+    roughly halves the parsed size. Only str instances are
+    shared: they are immutable, and keeping numbers out of the cache avoids
+    1, 1.0 and True collapsing into one value.
+    """
+    cache = {}
+    share = cache.setdefault
+
+    def hook(pairs):
+        obj = {}
+        for key, value in pairs:
+            if value.__class__ is str:
+                if len(value) <= max_length:
+                    value = share(value, value)
+            elif value.__class__ is list:
+                for idx, item in enumerate(value):
+                    if item.__class__ is str and len(item) <= max_length:
+                        value[idx] = share(item, item)
+            obj[share(key, key)] = value
+        return obj
+
+    return json.loads(json_doc, object_pairs_hook=hook)
+
+
 class JSONPatcher(object):
     """Patch JSON documents according to RFC 6902."""
 
-    def __init__(self, json_doc, *operations):
+    def __init__(self, json_doc, *operations, compact=False):
         try:
-            self.obj = json.loads(json_doc)  # let this fail if it must
+            # let this fail if it must
+            self.obj = compact_loads(json_doc) if compact else json.loads(json_doc)
         except (ValueError, TypeError):
             raise Exception("invalid JSON found")
         self.operations = operations
@@ -541,7 +1341,441 @@ class JSONPatcher(object):
         return obj, None, next_obj == value
 
 
+def dump_kwargs(pretty):
+    """Return json.dumps() arguments matching the module's `pretty` option."""
+    if pretty:
+        return {'indent': 4, 'separators': (',', ': ')}
+    return {}
+
+
+def read_document(src, create=False, create_type='object'):
+    """Read the JSON text at `src` and fingerprint what was read.
+
+    Returns `(text, state)`, where state is `(inode, mtime_ns, size, sha256)`
+    for unchanged_since(), or None if `src` does not exist yet. A missing or
+    empty file yields an empty document of `create_type` if `create` is set.
+    """
+    text, state = "", None
+    if os.path.isfile(src):
+        try:
+            with open(src, 'rb') as f:
+                st = os.fstat(f.fileno())
+                data = f.read()
+        except IOError:
+            raise IOError("could not read file at `%s`" % src)
+        text = data.decode('utf-8')
+        state = (st.st_ino, st.st_mtime_ns, st.st_size, hashlib.sha256(data).hexdigest())
+    elif not create:
+        raise IOError("could not find file at `%s`" % src)
+    if text == "" and create:
+        if create_type not in ('object', 'array'):
+            raise ValueError("invalid option for 'create_type': %s" % create_type)
+        text = "{}" if create_type == "object" else "[]"
+    return text, state
+
+
+def unchanged_since(path, state):
+    """Return whether `path` still holds the content read_document() fingerprinted.
+
+    Inode, mtime and size are compared first; the file is only hashed again
+    when they differ, so a rewrite with identical content is not a conflict.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return state is None
+    if state is None:
+        return False
+    if (st.st_ino, st.st_mtime_ns, st.st_size) == state[:3]:
+        return True
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest() == state[3]
+
+
+@contextmanager
+def commit_lock(path):
+    """Hold an exclusive flock on the directory of `path` while committing a write.
+
+    Only the final verify-and-rename runs under it, so concurrent patchers
+    read and patch in parallel; writers that do not take the lock are still
+    caught by unchanged_since(). Re-entrant within the process: a backup
+    taken under the lock may commit into the same directory.
+    """
+    import fcntl
+
+    directory = os.path.dirname(os.path.realpath(path))
+    if directory in _held_commit_locks:
+        yield
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        _held_commit_locks.add(directory)
+        yield
+    finally:
+        _held_commit_locks.discard(directory)
+        os.close(fd)
+
+
+_held_commit_locks = set()
+
+
+def write_atomic(path, text, verify=None):
+    """Replace `path` with `text` via a temporary file in the same directory.
+
+    `verify` is called right before the rename; if it returns False the
+    temporary file is discarded and ConflictError is raised.
+    """
+    path = os.path.realpath(path)
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            st = os.stat(path)
+            os.chmod(tmpfile, st.st_mode & 0o7777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmpfile, 0o666 & ~umask)
+        with commit_lock(path):
+            if verify is not None and not verify():
+                raise ConflictError("`%s` was modified while it was being patched" % path)
+            os.rename(tmpfile, path)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        raise
+
+
+def patch_file(src, operations, dest=None, pretty=False, create=False, create_type='object', check=False,
+               compact=False, retries=3, schema=None, schema_cache=None):
+    """Apply `operations` to the JSON file at `src` without Ansible.
+
+    Writes are optimistic: if `src` changes between reading and writing it,
+    the operations are re-applied to the new content, up to `retries` times.
+    With `schema` (a dict or a file name), a changed document is only
+    written if it matches that JSON Schema.
+
+    Returns a dict shaped like the module result (changed, tested, dest,
+    created, conflicts). Raises PathError, ValueError, IOError,
+    ConflictError or SchemaError on failure.
+    """
+    operations = list(operations)
+    validator = SchemaValidator(schema, schema_cache) if schema is not None else None
+    for attempt in range(retries + 1):
+        json_doc, state = read_document(src, create, create_type)
+        patcher = JSONPatcher(json_doc, *copy.deepcopy(operations), compact=compact)
+        changed, tested = patcher.patch()
+        result = {'changed': bool(changed), 'created': state is None}
+        if tested is not None:
+            result['tested'] = tested
+        if attempt:
+            result['conflicts'] = attempt
+        if not (changed or state is None):
+            return result
+        result['dest'] = dest or src
+        if validator is not None:
+            validator.validate(patcher.obj, operations, size=len(json_doc))
+        if check:
+            return result
+        try:
+            write_atomic(dest or src, json.dumps(patcher.obj, **dump_kwargs(pretty)),
+                         verify=lambda: unchanged_since(src, state))
+            return result
+        except ConflictError:
+            continue
+    raise ConflictError("`%s` kept changing while it was being patched, gave up after %d retries" % (src, retries))
+
+
+class Inotify(object):
+    """Minimal inotify(7) binding through ctypes, enough to watch directories."""
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    FILE_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE | IN_ATTRIB
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._get_errno = ctypes.get_errno
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self._get_errno(), 'inotify_init1 failed')
+        self.dirs = {}  # watch descriptor -> directory
+
+    def watch(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, directory.encode(), self.FILE_EVENTS)
+        if wd < 0:
+            raise OSError(self._get_errno(), "cannot watch `%s`" % directory)
+        self.dirs[wd] = directory
+
+    def read(self):
+        """Return the paths touched by pending events; None means events were lost."""
+        import struct
+
+        paths = set()
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return paths
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = struct.unpack_from('iIII', buf, offset)
+                offset += 16
+                name = buf[offset:offset + length].rstrip(b'\0').decode('utf-8', 'surrogateescape')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    return None
+                if wd in self.dirs and name:
+                    paths.add(os.path.join(self.dirs[wd], name))
+
+
+class DriftWatcher(object):
+    """Keep files patched: re-apply their operations whenever they drift.
+
+    Parent directories are watched with inotify (files are usually replaced
+    by rename, which a watch on the file itself would not survive). Bursts of
+    events are debounced, for at most `max_delay` seconds after the first
+    one, only the touched files are re-evaluated, and a file's handler
+    command runs once per batch in which it was re-patched. A file whose
+    content is the one the watcher last wrote or checked (touch, chmod, its
+    own writes) is not patched again. The process sleeps in poll() between
+    events.
+
+    The configuration is a JSON object:
+
+        {"debounce": 0.5,
+         "max_delay": 5,
+         "files": [{"path": "/etc/docker/daemon.json",
+                    "patch": "/etc/json_patch/daemon.ops.json",
+                    "pretty": true,
+                    "handler": "systemctl restart docker"}]}
+
+    where each entry takes either `patch` (a file with the operation list) or
+    inline `operations`, plus the patch_file() options pretty, create,
+    create_type, compact, schema and schema_cache.
+
+    Operations are re-applied to every edit of the file, so an add, copy or
+    move into an array (append `-` or index insert) must be guarded by a
+    `test` on that array or one of its ancestors: an entry with a failing
+    test is left alone instead of being written. Whether a path points into
+    an array is decided from the document itself, when the watcher starts
+    and again before every re-apply.
+    """
+
+    PATCH_OPTIONS = ('pretty', 'create', 'create_type', 'compact', 'schema', 'schema_cache')
+
+    def __init__(self, config, log=None):
+        self.debounce = float(config.get('debounce', 0.5))
+        self.max_delay = float(config.get('max_delay', 10 * self.debounce))
+        self.log = log or (lambda msg: print(msg, flush=True))
+        self.files = {}
+        for entry in config['files']:
+            entry = dict(entry)
+            if 'patch' in entry:
+                with open(entry['patch']) as f:
+                    entry['operations'] = json.load(f)
+            if isinstance(entry.get('operations'), dict):
+                entry['operations'] = [entry['operations']]
+            if not entry.get('operations'):
+                raise ValueError("'%s' has no operations" % entry.get('path'))
+            entry['guarded'] = any(op.get('op') == 'test' for op in entry['operations'])
+            tests = [op['path'].rstrip('/').split('/') for op in entry['operations'] if op.get('op') == 'test']
+            # inserts whose container no test covers: only harmless if that container is not an array
+            entry['inserts'] = [op for op in entry['operations']
+                                if op.get('op') in ('add', 'copy', 'move') and not any(
+                                    test == op['path'].split('/')[:len(test)] for test in tests
+                                    if len(test) < len(op['path'].split('/')))]
+            path = os.path.realpath(entry['path'])
+            if entry['inserts'] and os.path.isfile(path):
+                error = self._unguarded_insert(entry, path)
+                if error:
+                    raise ValueError(error)
+            self.files[path] = entry
+        self.settled = {}  # path -> sha256 of the content last written or found patched
+
+    @staticmethod
+    def _unguarded_insert(entry, path):
+        """Return why `entry` must not be re-applied to the document at `path`, or None."""
+        obj = json.loads(read_document(path, entry.get('create', False), entry.get('create_type', 'object'))[0])
+        for op in entry['inserts']:
+            container = obj
+            for elem in op['path'].split('/')[1:-1]:
+                if isinstance(container, dict):
+                    container = container.get(elem)
+                elif isinstance(container, list) and elem.isdigit() and int(elem) < len(container):
+                    container = container[int(elem)]
+                else:
+                    container = None
+            if isinstance(container, list):
+                return ("'%s': `%s %s` would insert again on every drift, guard it with a test on `%s` or above"
+                        % (entry['path'], op['op'], op['path'], op['path'].rsplit('/', 1)[0] or '/'))
+        return None
+
+    @staticmethod
+    def _digest(path):
+        try:
+            with open(path, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except (IOError, OSError):
+            return None
+
+    def reconcile(self, paths):
+        """Re-apply the operations of `paths`; return the handlers to run."""
+        handlers = []
+        for path in sorted(paths):
+            entry = self.files[path]
+            digest = self._digest(path)
+            if digest is not None and self.settled.get(path) == digest:
+                continue  # metadata change, or the event was our own write
+            options = dict((k, entry[k]) for k in self.PATCH_OPTIONS if k in entry)
+            try:
+                error = entry['inserts'] and self._unguarded_insert(entry, path)
+                if error:
+                    self.log("refused %s" % error)
+                    self.settled[path] = digest
+                    continue
+                if entry['guarded'] and patch_file(path, entry['operations'], check=True, **options).get('tested') is False:
+                    self.log("test failed %s, left alone" % path)
+                    self.settled[path] = digest
+                    continue
+                result = patch_file(path, entry['operations'], **options)
+            except Exception as e:  # keep watching the other files
+                self.log("failed %s: %s" % (path, e))
+                continue
+            if not result['changed']:
+                self.settled[path] = digest
+                continue
+            self.settled[path] = self._digest(path)
+            self.log("drift on %s, re-applied" % path)
+            if entry.get('handler') and entry['handler'] not in handlers:
+                handlers.append(entry['handler'])
+        return handlers
+
+    def run_handlers(self, handlers):
+        import subprocess
+
+        for handler in handlers:
+            rc = subprocess.call(handler, shell=True)
+            self.log("handler `%s` exited with %d" % (handler, rc))
+
+    def run(self):
+        import select
+
+        inotify = Inotify()
+        for directory in sorted(set(os.path.dirname(path) for path in self.files)):
+            inotify.watch(directory)
+        self.log("watching %d files" % len(self.files))
+        self.run_handlers(self.reconcile(self.files))
+
+        poller = select.poll()
+        poller.register(inotify.fd, select.POLLIN)
+        pending, first, deadline = set(), None, None
+        while True:
+            timeout = None if deadline is None else max(0, (deadline - time.monotonic()) * 1000)
+            if poller.poll(timeout):
+                touched = inotify.read()
+                touched = set(self.files) if touched is None else touched.intersection(self.files)
+                if touched:
+                    pending.update(touched)
+                    now = time.monotonic()
+                    first = first or now
+                    deadline = min(now + self.debounce, first + self.max_delay)  # a steady stream still gets fixed
+            if deadline is not None and time.monotonic() >= deadline:
+                paths, pending, first, deadline = pending, set(), None, None
+                self.run_handlers(self.reconcile(paths))
+
+
+def cli(argv=None):
+    """Entry point for `python json_patch.py apply ...`."""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='json_patch.py', description='Apply RFC 6902 JSON patches to files.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    apply_parser = sub.add_parser('apply', help='apply a list of patch operations to one or more JSON files')
+    apply_parser.add_argument('files', nargs='+', metavar='FILE')
+    apply_parser.add_argument('-p', '--patch', default='-',
+                              help='JSON file with the list of operations (default: read from stdin)')
+    apply_parser.add_argument('-d', '--dest', help='write the result here instead of FILE (single FILE only)')
+    apply_parser.add_argument('--pretty', action='store_true')
+    apply_parser.add_argument('--create', action='store_true')
+    apply_parser.add_argument('--create-type', default='object', choices=('object', 'array'))
+    apply_parser.add_argument('--check', action='store_true', help='report changes without writing them')
+    apply_parser.add_argument('--compact', action='store_true', help='memory-compact parsing for large documents')
+    apply_parser.add_argument('--retries', type=int, default=3,
+                              help='re-apply this often when FILE changes while being patched')
+    apply_parser.add_argument('--schema', help='JSON Schema file the patched documents must match')
+    apply_parser.add_argument('--schema-cache', help='directory for compiled schemas (default: %s)' % SCHEMA_CACHE)
+    restore_parser = sub.add_parser('restore', help='restore a backup taken with the backup_store option')
+    restore_parser.add_argument('backup', help='backup path as returned by the module')
+    restore_parser.add_argument('dest', nargs='?', help='where to restore to (default: the backed up file)')
+    watch_parser = sub.add_parser('watch', help='re-apply patches whenever the patched files drift')
+    watch_parser.add_argument('config', help='JSON file listing the files to keep patched (see DriftWatcher)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'watch':
+        with open(args.config) as f:
+            watcher = DriftWatcher(json.load(f))
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.command == 'restore':
+        store = os.path.dirname(os.path.dirname(os.path.abspath(args.backup)))
+        try:
+            print("restored %s" % BackupStore(store).restore(args.backup, args.dest))
+        except (IOError, OSError, ValueError, KeyError) as e:
+            print("failed %s: %s" % (args.backup, e), file=sys.stderr)
+            return 1
+        return 0
+
+    if args.dest and len(args.files) > 1:
+        parser.error('--dest requires a single FILE')
+    if args.patch == '-':
+        operations = json.load(sys.stdin)
+    else:
+        with open(args.patch) as f:
+            operations = json.load(f)
+    if isinstance(operations, dict):
+        operations = [operations]
+
+    rc = 0
+    for src in args.files:
+        try:
+            result = patch_file(src, operations, dest=args.dest, pretty=args.pretty, create=args.create,
+                                create_type=args.create_type, check=args.check, compact=args.compact,
+                                retries=args.retries, schema=args.schema, schema_cache=args.schema_cache)
+        except Exception as e:  # JSONPatcher raises a bare Exception for invalid JSON
+            print("failed %s: %s" % (src, e), file=sys.stderr)
+            rc = 1
+            continue
+        if result.get('tested') is False:
+            print("test failed %s" % src)
+            rc = 1
+        else:
+            print("%s %s" % ('changed' if result['changed'] else 'ok', src))
+    return rc
+
+
 def main():
+    from ansible.module_utils import basic
+
     # Parsing argument file
     module = basic.AnsibleModule(
         argument_spec=dict(
@@ -549,19 +1783,30 @@ def main():
             dest=dict(required=False, type='str'),
             operations=dict(required=True, type='list'),
             backup=dict(required=False, default=False, type='bool'),
+            backup_store=dict(required=False, type='str'),
+            backup_retention=dict(required=False, default=10, type='int'),
+            cas_retries=dict(required=False, default=3, type='int'),
             unsafe_writes=dict(required=False, default=False, type='bool'),
             pretty=dict(required=False, default=False, type='bool'),
             create=dict(required=False, default=False, type='bool'),
             create_type=dict(required=False, default='object', type='str'),
+            compact=dict(required=False, default=False, type='bool'),
+            schema=dict(required=False, type='raw'),
+            schema_cache=dict(required=False, type='str'),
+            metrics_pushgateway=dict(required=False, type='str'),
+            metrics_textfile=dict(required=False, type='str'),
         ),
         supports_check_mode=True
     )
 
     manager = PatchManager(module)
     result = manager.run()
+    manager.flush_metrics()
 
     module.exit_json(**result)
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        sys.exit(cli())
     main()
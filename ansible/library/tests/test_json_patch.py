@@ -1,15 +1,45 @@
 #!/usr/bin/env python3
 """Unit tests for json_patch custom module."""
 
+import hashlib
 import json
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
+import tracemalloc
 import unittest
+import zlib
+from unittest import mock
 
 # Add parent directory to path for importing json_patch
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from json_patch import JSONPatcher
+import json_patch
+from json_patch import (BackupStore, ConflictError, DriftWatcher, JSONPatcher, Metrics, NullMetrics, SchemaError,
+                        SchemaValidator, compact_loads, patch_file)
+
+try:
+    import ansible  # noqa: F401
+    HAS_ANSIBLE = True
+except ImportError:
+    HAS_ANSIBLE = False
+
+try:
+    import fastjsonschema
+    HAS_FASTJSONSCHEMA = True
+except ImportError:
+    HAS_FASTJSONSCHEMA = False
+
+try:
+    import jsonschema  # noqa: F401
+    HAS_JSONSCHEMA = True
+except ImportError:
+    HAS_JSONSCHEMA = False
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'json_patch.py')
 
 
 class TestJSONPatcher(unittest.TestCase):
@@ -146,6 +176,16 @@ class TestJSONPatcher(unittest.TestCase):
         # Adding existing value should not modify
         self.assertFalse(modified)
 
+    def test_idempotency_compares_values_not_encodings(self):
+        """Test that equal containers match regardless of key order and number type."""
+        doc = json.dumps({"foo": {"one": 1, "list": [1.0, {"a": True, "b": None}]}})
+        value = {"list": [1, {"b": None, "a": True}], "one": 1.0}
+        patcher = JSONPatcher(doc,
+                              {"op": "add", "path": "/foo", "value": value},
+                              {"op": "replace", "path": "/foo", "value": value},
+                              {"op": "test", "path": "/foo", "value": value})
+        self.assertEqual(patcher.patch(), (None, True))
+
     def test_multiple_operations(self):
         """Test multiple operations in sequence."""
         patcher = JSONPatcher(self.sample_json,
@@ -213,5 +253,753 @@ class TestJSONPatcher(unittest.TestCase):
         self.assertEqual(patcher.obj[0], "first")
 
 
+class TestMetrics(unittest.TestCase):
+    """Test run metrics rendering and delivery."""
+
+    def setUp(self):
+        """Create a scratch directory for textfiles."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_render_counter_and_histogram(self):
+        """Test the Prometheus text exposition of counters and histograms."""
+        metrics = Metrics('json_patch')
+        metrics.inc('json_patch_runs_total', 'runs', labels={'changed': 'true'})
+        metrics.inc('json_patch_runs_total', 'runs', labels={'changed': 'true'})
+        metrics.observe('json_patch_duration_seconds', 'duration', 0.02, labels={'phase': 'patch'})
+        text = metrics.render()
+        self.assertIn('# TYPE json_patch_runs_total counter', text)
+        self.assertIn('json_patch_runs_total{changed="true"} 2', text)
+        self.assertIn('json_patch_duration_seconds_bucket{phase="patch",le="0.01"} 0', text)
+        self.assertIn('json_patch_duration_seconds_bucket{phase="patch",le="0.025"} 1', text)
+        self.assertIn('json_patch_duration_seconds_bucket{phase="patch",le="+Inf"} 1', text)
+        self.assertIn('json_patch_duration_seconds_count{phase="patch"} 1', text)
+
+    def textfiles(self):
+        found = {}
+        for name in sorted(os.listdir(self.tmpdir)):
+            if name.endswith('.prom'):
+                with open(os.path.join(self.tmpdir, name)) as f:
+                    found[name] = f.read()
+        return found
+
+    def test_textfile_fallback_when_pushgateway_unreachable(self):
+        """Test that metrics land in the textfile of their group, with its labels, when the push fails."""
+        metrics = Metrics('json_patch', pushgateway='http://127.0.0.1:1', textfile=self.tmpdir,
+                          grouping={'dest': '/etc/a "b".json'}, state_dir=os.path.join(self.tmpdir, 'state'))
+        metrics.inc('json_patch_runs_total', 'runs')
+        error = metrics.flush()
+        self.assertIn('could not push metrics', error)
+        [text] = self.textfiles().values()
+        self.assertIn('json_patch_runs_total{dest="/etc/a \\"b\\".json"} 1\n', text)
+        self.assertNotIn('instance=', text)
+
+    def test_runs_accumulate_per_group(self):
+        """Test that counters and histograms add up across runs of a group, and gauges keep the last value."""
+        def run(dest, changed, when):
+            metrics = Metrics('json_patch', textfile=self.tmpdir, grouping={'dest': dest, 'instance': 'host1'},
+                              state_dir=os.path.join(self.tmpdir, 'state'))
+            metrics.inc('json_patch_runs_total', 'runs', labels={'changed': changed})
+            metrics.observe('json_patch_duration_seconds', 'duration', 0.02, labels={'phase': 'patch'})
+            metrics.set('json_patch_last_run_timestamp_seconds', 'last run', when)
+            self.assertIsNone(metrics.flush())
+
+        run('/a.json', 'true', 100)
+        run('/a.json', 'false', 200)
+        run('/a.json', 'true', 300)
+        run('/b.json', 'true', 400)
+        texts = sorted(self.textfiles().values(), key=len)
+        self.assertEqual(len(texts), 2)
+        text = texts[1]
+        self.assertIn('json_patch_runs_total{dest="/a.json",changed="true"} 2\n', text)
+        self.assertIn('json_patch_runs_total{dest="/a.json",changed="false"} 1\n', text)
+        self.assertIn('json_patch_duration_seconds_count{dest="/a.json",phase="patch"} 3\n', text)
+        self.assertIn('json_patch_duration_seconds_bucket{dest="/a.json",phase="patch",le="0.025"} 3\n', text)
+        self.assertIn('json_patch_last_run_timestamp_seconds{dest="/a.json"} 300\n', text)
+        self.assertIn('json_patch_runs_total{dest="/b.json",changed="true"} 1\n', texts[0])
+
+    def test_null_metrics_is_noop(self):
+        """Test that disabled metrics accept calls without collecting anything."""
+        metrics = NullMetrics()
+        with metrics.time('json_patch_duration_seconds', 'duration'):
+            metrics.inc('json_patch_runs_total', 'runs')
+        self.assertIsNone(metrics.flush())
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    @unittest.skipUnless(HAS_ANSIBLE, 'needs ansible')
+    def test_module_counts_completed_operations_and_bytes(self):
+        """Test the module's counters and byte sizes through real module runs on two files."""
+        paths = [os.path.join(self.tmpdir, name) for name in ('doc.json', 'other.json')]
+        for path in paths:
+            with open(path, 'w') as f:
+                f.write('{"name": "caf\u00e9"}')
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.join(self.tmpdir, 'cache'))
+        for path in paths + paths[:1]:
+            args = os.path.join(self.tmpdir, 'args.json')
+            with open(args, 'w') as f:
+                json.dump({'ANSIBLE_MODULE_ARGS': {
+                    'src': path, 'metrics_textfile': self.tmpdir,
+                    'operations': [{'op': 'add', 'path': '/x', 'value': 1}, {'op': 'test', 'path': '/x', 'value': 1}]}}, f)
+            proc = subprocess.run([sys.executable, MODULE_PATH, args], capture_output=True, text=True, check=False,
+                                  env=env)
+            self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+        texts = dict(('changed="false"' in text, text) for text in self.textfiles().values())
+        self.assertEqual(len(texts), 2)
+        text = texts[True]  # doc.json: changed, then unchanged
+        dest = 'dest="%s"' % paths[0]
+        self.assertIn('json_patch_runs_total{%s,changed="true"} 1\n' % dest, text)
+        self.assertIn('json_patch_runs_total{%s,changed="false"} 1\n' % dest, text)
+        self.assertIn('json_patch_operations_total{%s,changed="true",op="add"} 1\n' % dest, text)
+        self.assertIn('json_patch_operations_total{%s,changed="false",op="test"} 1\n' % dest, text)
+        # 17 bytes ("caf\u00e9" is 5 of them), then the 29 of the patched document
+        self.assertIn('json_patch_file_size_bytes_sum{%s,stage="before"} 46\n' % dest, text)
+        self.assertIn('json_patch_last_run_timestamp_seconds{%s} ' % dest, text)
+        self.assertIn('dest="%s"' % paths[1], texts[False])
+
+
+class TestCompactLoad(unittest.TestCase):
+    """Test the memory-compact loader."""
+
+    def setUp(self):
+        """Build an inventory-style document of similar objects."""
+        self.doc = json.dumps({"hosts": [
+            {"name": "host%04d" % i, "state": ("running", "stopped")[i % 2], "arch": "x86_64",
+             "enabled": i % 3 == 0, "cpu": i % 8, "tags": ["web", "db"][:i % 3]}
+            for i in range(5000)
+        ]})
+
+    def test_same_document(self):
+        """Test that compact parsing yields an equal document with shared strings."""
+        obj = compact_loads(self.doc)
+        self.assertEqual(obj, json.loads(self.doc))
+        self.assertIs(obj["hosts"][0]["arch"], obj["hosts"][1]["arch"])
+        self.assertIs(obj["hosts"][1]["tags"][0], obj["hosts"][4]["tags"][0])
+        self.assertIs(compact_loads('[{"a": true, "b": 1}]')[0]["a"], True)
+
+    def test_operations_are_transparent(self):
+        """Test that every operation behaves the same on a compact document."""
+        operations = [
+            {"op": "add", "path": "/hosts/0/arch", "value": "aarch64"},
+            {"op": "replace", "path": "/hosts/1/state", "value": "running"},
+            {"op": "remove", "path": "/hosts/2/tags/0"},
+            {"op": "copy", "from": "/hosts/3/state", "path": "/hosts/4/previous"},
+            {"op": "move", "from": "/hosts/5/cpu", "path": "/hosts/5/cores"},
+            {"op": "test", "path": "/hosts/*/name", "value": "host0042"},
+        ]
+        results = []
+        for compact in (False, True):
+            patcher = JSONPatcher(self.doc, *json.loads(json.dumps(operations)), compact=compact)
+            results.append((patcher.patch(), patcher.obj))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1][1]["hosts"][1]["arch"], "x86_64")
+
+    def test_uses_less_memory(self):
+        """Test that the compact document is smaller than the default one."""
+        sizes = []
+        for loads in (json.loads, compact_loads):
+            tracemalloc.start()
+            obj = loads(self.doc)
+            sizes.append(tracemalloc.get_traced_memory()[0])
+            tracemalloc.stop()
+            del obj
+        self.assertLess(sizes[1], sizes[0] * 0.8)
+
+
+class TestPatchFile(unittest.TestCase):
+    """Test the standalone entry points that run without Ansible."""
+
+    def setUp(self):
+        """Create a scratch JSON file."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'doc.json')
+        with open(self.path, 'w') as f:
+            json.dump({"foo": {"one": 1}}, f)
+        os.chmod(self.path, 0o600)
+
+    def read(self, path=None):
+        with open(path or self.path) as f:
+            return json.load(f)
+
+    def test_patch_file_writes_changes(self):
+        """Test that a change is written in place and keeps the file mode."""
+        result = patch_file(self.path, [{"op": "add", "path": "/foo/two", "value": 2}])
+        self.assertTrue(result['changed'])
+        self.assertEqual(self.read(), {"foo": {"one": 1, "two": 2}})
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_patch_file_is_reusable_and_idempotent(self):
+        """Test that operations are not consumed and a re-apply is a no-op."""
+        operations = [{"op": "add", "path": "/foo/two", "value": 2}]
+        patch_file(self.path, operations)
+        mtime = os.stat(self.path).st_mtime_ns
+        result = patch_file(self.path, operations)
+        self.assertFalse(result['changed'])
+        self.assertEqual(operations[0]['op'], 'add')
+        self.assertEqual(os.stat(self.path).st_mtime_ns, mtime)
+
+    def test_patch_file_check_and_create(self):
+        """Test check mode and creating a missing file."""
+        new_path = os.path.join(self.tmpdir, 'new.json')
+        result = patch_file(new_path, [{"op": "add", "path": "/-", "value": 1}], create=True,
+                            create_type='array', check=True)
+        self.assertTrue(result['changed'])
+        self.assertFalse(os.path.exists(new_path))
+        patch_file(new_path, [{"op": "add", "path": "/-", "value": 1}], create=True, create_type='array')
+        self.assertEqual(self.read(new_path), [1])
+
+    def concurrent_writer(self, times):
+        """Wrap write_atomic so another writer changes the file `times` times before our rename."""
+        real_write = json_patch.write_atomic
+        calls = []
+
+        def racing_write(path, text, verify=None):
+            if len(calls) < times:
+                doc = self.read()
+                doc["writer%d" % len(calls)] = True
+                with open(self.path, 'w') as f:
+                    json.dump(doc, f)
+            calls.append(path)
+            return real_write(path, text, verify)
+
+        return mock.patch.object(json_patch, 'write_atomic', racing_write)
+
+    def test_concurrent_change_is_not_lost(self):
+        """Test that a change made between read and write is kept and the patch re-applied."""
+        with self.concurrent_writer(2):
+            result = patch_file(self.path, [{"op": "add", "path": "/foo/two", "value": 2}])
+        self.assertEqual(result['conflicts'], 2)
+        self.assertEqual(self.read(), {"foo": {"one": 1, "two": 2}, "writer0": True, "writer1": True})
+
+    def test_concurrent_change_gives_up_after_retries(self):
+        """Test that the retries are bounded."""
+        with self.concurrent_writer(10):
+            with self.assertRaises(ConflictError):
+                patch_file(self.path, [{"op": "add", "path": "/foo/two", "value": 2}], retries=2)
+        self.assertNotIn("two", self.read()["foo"])
+
+    def test_identical_rewrite_is_not_a_conflict(self):
+        """Test that replacing the file with the same content does not force a retry."""
+        with open(self.path) as f:
+            content = f.read()
+        real_write = json_patch.write_atomic
+
+        def rewrite_same(path, text, verify=None):
+            os.unlink(self.path)
+            with open(self.path, 'w') as f:
+                f.write(content)
+            return real_write(path, text, verify)
+
+        with mock.patch.object(json_patch, 'write_atomic', rewrite_same):
+            result = patch_file(self.path, [{"op": "add", "path": "/foo/two", "value": 2}])
+        self.assertNotIn('conflicts', result)
+        self.assertEqual(self.read()["foo"]["two"], 2)
+
+    def test_parallel_writers_keep_every_update(self):
+        """Test that parallel patch processes on one file do not lose updates."""
+        procs = [subprocess.Popen([sys.executable, MODULE_PATH, 'apply', '--retries', '10', self.path],
+                                  stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+                 for _ in range(8)]
+        for i, proc in enumerate(procs):
+            proc.stdin.write('{"op": "add", "path": "/key%d", "value": %d}' % (i, i))
+            proc.stdin.close()
+        for proc in procs:
+            proc.wait()
+        self.assertEqual([proc.returncode for proc in procs], [0] * 8)
+        self.assertEqual(sorted(self.read()), ["foo"] + ["key%d" % i for i in range(8)])
+
+    def test_cli_reads_stdin_without_ansible(self):
+        """Test the apply command on several files with operations from stdin, loading no optional library."""
+        other = os.path.join(self.tmpdir, 'other.json')
+        with open(other, 'w') as f:
+            f.write('{}')
+        code = ("import runpy, sys; sys.argv = [%r, 'apply', %r, %r]; "
+                "sys.exit(runpy.run_path(%r, run_name='__main__'))" % (MODULE_PATH, self.path, other, MODULE_PATH))
+        probe = ("import atexit, sys; atexit.register(lambda: print(any(name in sys.modules for name in "
+                 "('ansible', 'fastjsonschema', 'jsonschema')))); " + code)
+        proc = subprocess.run([sys.executable, '-c', probe], input='{"op": "add", "path": "/enabled", "value": true}',
+                              capture_output=True, text=True, check=False)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertIn('changed %s' % other, proc.stdout)
+        self.assertTrue(proc.stdout.strip().endswith('False'))
+        self.assertTrue(self.read(other)['enabled'])
+
+
+class FakeModule(object):
+    """Just enough of AnsibleModule to drive a PatchManager."""
+
+    check_mode = False
+
+    def __init__(self, **params):
+        self.params = dict(create=False, dest=None, backup=False, backup_store=None, pretty=False, unsafe_writes=False,
+                           cas_retries=3, compact=False, schema=None)
+        self.params.update(params)
+        self.backups = []
+
+    def atomic_move(self, src, dest, unsafe_writes=False):
+        shutil.move(src, dest)
+
+    def backup_local(self, path):
+        self.backups.append(path)
+        return path + '.bak'
+
+    def fail_json(self, **kwargs):
+        raise AssertionError(kwargs['msg'])
+
+
+@unittest.skipUnless(HAS_ANSIBLE, 'needs ansible')
+class TestPatchManager(unittest.TestCase):
+    """Test the Ansible side of writing a patched file."""
+
+    def setUp(self):
+        """Create a scratch JSON file."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'doc.json')
+        with open(self.path, 'w') as f:
+            json.dump({"foo": 1}, f)
+
+    def test_backup_once_across_conflict_retries(self):
+        """Test that only the write that wins the compare-and-swap takes a backup."""
+        module = FakeModule(src=self.path, backup=True, operations=[{'op': 'add', 'path': '/bar', 'value': 2}])
+        with mock.patch.object(json_patch, 'unchanged_since', side_effect=[False, False, True]):
+            result = json_patch.PatchManager(module).run()
+        self.assertEqual(result['conflicts'], 2)
+        self.assertEqual(module.backups, [self.path])
+
+    def test_disabled_metrics_measure_nothing(self):
+        """Test that without metrics options no sizes are computed for them."""
+        module = FakeModule(src=self.path, operations=[{'op': 'add', 'path': '/bar', 'value': 2}])
+        with mock.patch.object(NullMetrics, 'observe', side_effect=AssertionError('measured')):
+            self.assertTrue(json_patch.PatchManager(module).run()['changed'])
+
+    def test_backup_store_next_to_the_file(self):
+        """Test a backup store sharing the patched file's directory and its commit lock."""
+        module = FakeModule(src=self.path, backup=True, backup_store=self.tmpdir,
+                            operations=[{'op': 'add', 'path': '/bar', 'value': 2}])
+        result = json_patch.PatchManager(module).run()
+        target = os.path.join(self.tmpdir, 'restored.json')
+        BackupStore(self.tmpdir).restore(result['backup'], target)
+        self.assertEqual(self.read(target), {"foo": 1})
+        self.assertEqual(self.read(self.path), {"foo": 1, "bar": 2})
+
+    def read(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+
+class TestBackupStore(unittest.TestCase):
+    """Test the deduplicated backup store."""
+
+    def setUp(self):
+        """Create a file to back up and an empty store."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'daemon.json')
+        self.store_dir = os.path.join(self.tmpdir, 'store')
+        self.versions = []
+
+    def write_version(self, i):
+        doc = {"log-driver": "json-file", "hosts": ["h%d" % n for n in range(200)], "version": i}
+        patch_file(self.path, [{"op": "add", "path": "/doc", "value": doc}], create=True)
+        with open(self.path) as f:
+            self.versions.append(f.read())
+
+    def objects(self):
+        return sorted(os.listdir(os.path.join(self.store_dir, 'objects')))
+
+    def kinds(self):
+        with open(os.path.join(self.store_dir, 'index.json')) as f:
+            index = json.load(f)
+        return [index['objects'][entry['sha']]['kind'] for entry in index['files'][os.path.realpath(self.path)]]
+
+    def test_identical_content_is_stored_once(self):
+        """Test that repeated backups of the same content share one object."""
+        self.write_version(1)
+        store = BackupStore(self.store_dir)
+        first, second = store.backup(self.path), store.backup(self.path)
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(self.objects()), 1)
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+
+    @mock.patch.object(BackupStore, '_clone', return_value=None)
+    def test_deltas_restore_every_version(self, _clone):
+        """Test compressed deltas when the filesystem cannot reflink."""
+        store = BackupStore(self.store_dir)
+        names = []
+        for i in range(4):
+            self.write_version(i)
+            names.append(store.backup(self.path))
+        self.assertEqual(self.kinds(), ['zfull', 'delta', 'delta', 'delta'])
+        self.assertEqual([name.rsplit('~', 1)[1] for name in names], ['.z', '.delta', '.delta', '.delta'])
+        for i, name in enumerate(names):
+            target = os.path.join(self.tmpdir, 'restored%d.json' % i)
+            store.restore(name, target)
+            with open(target) as f:
+                self.assertEqual(f.read(), self.versions[i])
+
+    @mock.patch.object(BackupStore, '_clone', return_value=None)
+    def test_retention_expires_old_backups(self, _clone):
+        """Test that only the newest backups are kept and still restorable, a rebased delta by either name."""
+        store = BackupStore(self.store_dir, retention=2)
+        names = []
+        for i in range(5):
+            self.write_version(i)
+            names.append(store.backup(self.path))
+        rebased = names[3][:-len('.delta')] + '.z'  # its base expired, so it was rewritten in full
+        self.assertEqual(sorted(os.listdir(os.path.join(self.store_dir, 'names'))),
+                         [os.path.basename(rebased), os.path.basename(names[4])])
+        self.assertEqual(self.kinds(), ['zfull', 'delta'])
+        with open(rebased, 'rb') as f:
+            self.assertEqual(zlib.decompress(f.read()).decode(), self.versions[3])
+        store.restore(names[3])
+        with open(self.path) as f:
+            self.assertEqual(f.read(), self.versions[3])
+
+    def test_in_place_rewrite_keeps_backup(self):
+        """Test that rewriting the file in place does not change its backups."""
+        self.write_version(1)
+        store = BackupStore(self.store_dir)
+        name = store.backup(self.path)
+        with open(self.path, 'w') as f:
+            f.write('{}')
+        target = os.path.join(self.tmpdir, 'restored.json')
+        store.restore(name, target)
+        with open(target) as f:
+            self.assertEqual(f.read(), self.versions[0])
+
+    def test_interrupted_backup_leaves_nothing_in_the_way(self):
+        """Test that a failed backup is rolled back and a stray object does not block the next one."""
+        self.write_version(1)
+        store = BackupStore(self.store_dir)
+        with mock.patch.object(BackupStore, '_expire', side_effect=OSError('disk full')):
+            self.assertRaises(OSError, store.backup, self.path)
+        self.assertEqual(self.objects(), [])
+        self.assertEqual(os.listdir(os.path.join(self.store_dir, 'names')), [])
+        with open(self.path, 'rb') as f:
+            sha = hashlib.sha256(f.read()).hexdigest()
+        for stray in (sha, sha + '.z'):  # as left by a killed run
+            with open(os.path.join(self.store_dir, 'objects', stray), 'w') as f:
+                f.write('partial')
+        name = store.backup(self.path)
+        target = os.path.join(self.tmpdir, 'restored.json')
+        store.restore(name, target)
+        with open(target) as f:
+            self.assertEqual(f.read(), self.versions[0])
+
+    def test_writers_sharing_a_store_do_not_deadlock(self):
+        """Test two patchers backing up into a store that sits next to one of their files."""
+        d1, d2 = os.path.join(self.tmpdir, 'd1'), os.path.join(self.tmpdir, 'd2')
+        for directory in (d1, d2):
+            os.mkdir(directory)
+            with open(os.path.join(directory, 'f.json'), 'w') as f:
+                f.write('{}')
+        script = ("import sys; sys.path.insert(0, %r); import json_patch\n"
+                  "for i in range(50):\n"
+                  "    with json_patch.commit_lock(sys.argv[1]):\n"
+                  "        json_patch.BackupStore(%r).backup(sys.argv[1])\n"
+                  "    name = json_patch.BackupStore(%r).backup(sys.argv[1])\n"
+                  "    with json_patch.commit_lock(sys.argv[1]):\n"
+                  "        json_patch.BackupStore(%r).restore(name)\n"
+                  % (os.path.dirname(MODULE_PATH), d1, d1, d1))
+        procs = [subprocess.Popen([sys.executable, '-c', script, os.path.join(directory, 'f.json')])
+                 for directory in (d1, d2)]
+        for proc in procs:
+            try:
+                self.assertEqual(proc.wait(timeout=30), 0)
+            except subprocess.TimeoutExpired:
+                for other in procs:
+                    other.kill()
+                    other.wait()
+                self.fail('writers deadlocked')
+
+    def test_cli_restore(self):
+        """Test restoring a backup through the command line."""
+        self.write_version(1)
+        name = BackupStore(self.store_dir).backup(self.path)
+        self.write_version(2)
+        proc = subprocess.run([sys.executable, MODULE_PATH, 'restore', name], capture_output=True, text=True,
+                              check=False)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), self.versions[0])
+
+
+@unittest.skipUnless(HAS_FASTJSONSCHEMA or HAS_JSONSCHEMA, 'needs fastjsonschema or jsonschema')
+class TestSchemaValidation(unittest.TestCase):
+    """Test validating patched documents against a JSON Schema."""
+
+    SCHEMA = {
+        "type": "object",
+        "required": ["log-driver"],
+        "additionalProperties": False,
+        "properties": {
+            "log-driver": {"type": "string"},
+            "live-restore": {"type": "boolean"},
+            "log-opts": {"type": "object", "additionalProperties": {"type": "string"}},
+            "dns": {"type": "array", "items": {"type": "string"}},
+        },
+    }
+
+    def setUp(self):
+        """Create a scratch daemon.json and schema cache."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache = os.path.join(self.tmpdir, 'cache')
+        self.path = os.path.join(self.tmpdir, 'daemon.json')
+        with open(self.path, 'w') as f:
+            json.dump({"log-driver": "json-file", "log-opts": {"max-size": "10m"}, "dns": ["1.1.1.1"]}, f)
+        compiled = dict(SchemaValidator._compiled)
+        self.addCleanup(SchemaValidator._compiled.update, compiled)
+        self.addCleanup(SchemaValidator._compiled.clear)
+
+    def read(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def patch(self, *operations, **kwargs):
+        return patch_file(self.path, list(operations), schema=kwargs.pop('schema', self.SCHEMA),
+                          schema_cache=self.cache, **kwargs)
+
+    def test_invalid_result_is_not_written(self):
+        """Test that a document breaking the schema is rejected before the write."""
+        before = self.read()
+        for op in ({"op": "add", "path": "/live-restore", "value": "yes"},
+                   {"op": "remove", "path": "/log-driver"},
+                   {"op": "add", "path": "/debug", "value": True}):
+            with self.assertRaises(SchemaError):
+                self.patch(op)
+            self.assertEqual(self.read(), before)
+        with self.assertRaises(SchemaError):
+            self.patch({"op": "add", "path": "/live-restore", "value": "yes"}, check=True)
+
+    def test_valid_result_is_written(self):
+        """Test that a matching document is written, with the schema read from a file."""
+        schema_path = os.path.join(self.tmpdir, 'schema.json')
+        with open(schema_path, 'w') as f:
+            json.dump(self.SCHEMA, f)
+        self.assertTrue(self.patch({"op": "add", "path": "/live-restore", "value": True}, schema=schema_path)['changed'])
+        self.assertTrue(self.read()["live-restore"])
+
+    @unittest.skipUnless(HAS_FASTJSONSCHEMA, 'needs fastjsonschema')
+    def test_compiled_schema_is_cached_on_disk(self):
+        """Test that a later run imports the compiled schema instead of generating it."""
+        self.patch({"op": "add", "path": "/live-restore", "value": True})
+        cached = os.listdir(self.cache)
+        self.assertEqual(len([name for name in cached if name.endswith('.py')]), 1)
+        SchemaValidator._compiled.clear()
+        with mock.patch.object(fastjsonschema, 'compile_to_code') as compile_to_code:
+            with self.assertRaises(SchemaError):
+                self.patch({"op": "add", "path": "/live-restore", "value": "no"})
+        compile_to_code.assert_not_called()
+
+    @unittest.skipUnless(HAS_FASTJSONSCHEMA, 'needs fastjsonschema')
+    def test_cached_code_others_can_write_is_not_run(self):
+        """Test that compiled schemas are not loaded from a shared cache or a file others may have replaced."""
+        self.patch({"op": "add", "path": "/live-restore", "value": True})
+        cached = os.path.join(self.cache, [name for name in os.listdir(self.cache) if name.endswith('.py')][0])
+        marker = os.path.join(self.tmpdir, 'pwned')
+        planted = 'open(%r, "w").close()\ndef validate(data, name_prefix=None):\n    pass\n' % marker
+        for unsafe, mode in ((cached, 0o666), (self.cache, 0o777)):
+            with open(cached, 'w') as f:
+                f.write(planted)
+            os.chmod(unsafe, mode)
+            SchemaValidator._compiled.clear()
+            with self.assertRaises(SchemaError):
+                self.patch({"op": "add", "path": "/live-restore", "value": "no"})
+            self.assertFalse(os.path.exists(marker))
+
+    def test_jsonschema_fallback(self):
+        """Test validating with jsonschema when fastjsonschema is missing."""
+        if not HAS_JSONSCHEMA:
+            self.skipTest('needs jsonschema')
+        SchemaValidator._compiled.clear()
+        with mock.patch.dict(sys.modules, {'fastjsonschema': None}):
+            with self.assertRaises(SchemaError) as context:
+                self.patch({"op": "add", "path": "/dns/-", "value": 8})
+            self.assertIn("data.dns[1]", str(context.exception))
+            self.patch({"op": "add", "path": "/dns/-", "value": "8.8.8.8"})
+        self.assertFalse(os.path.exists(self.cache))
+
+    def test_large_documents_validate_touched_subtrees(self):
+        """Test that only the touched subtrees and their ancestors' own keywords are checked."""
+        validator = SchemaValidator(self.SCHEMA, self.cache, subtree_size=0)
+        doc = {"log-driver": "json-file", "log-opts": {"max-size": 10}, "dns": ["1.1.1.1"]}
+        # the invalid log-opts were not touched
+        validator.validate(doc, [{"op": "add", "path": "/dns/0", "value": "9.9.9.9"}], size=1)
+        with self.assertRaises(SchemaError):
+            validator.validate(doc, [{"op": "replace", "path": "/log-opts/max-size", "value": 10}], size=1)
+        with self.assertRaises(SchemaError):  # additionalProperties of the root
+            validator.validate(dict(doc, debug=True), [{"op": "add", "path": "/debug", "value": True}], size=1)
+        with self.assertRaises(SchemaError):  # required of the root
+            validator.validate({"dns": []}, [{"op": "remove", "path": "/log-driver"}], size=1)
+        with self.assertRaises(SchemaError):  # below the threshold the whole document is checked
+            SchemaValidator(self.SCHEMA, self.cache).validate(doc, [{"op": "add", "path": "/dns/0", "value": "9.9.9.9"}],
+                                                              size=1)
+
+    def test_references_fall_back_to_the_whole_document(self):
+        """Test that schemas that cannot be followed along a path are checked as a whole."""
+        schema = {"definitions": {"opts": {"type": "object", "additionalProperties": {"type": "string"}}},
+                  "type": "object", "properties": {"log-opts": {"$ref": "#/definitions/opts"}}}
+        validator = SchemaValidator(schema, self.cache, subtree_size=0)
+        doc = {"log-opts": {"max-size": 10}, "dns": []}
+        operations = [{"op": "add", "path": "/log-opts/max-file", "value": "3"}]
+        self.assertIsNone(validator.subtree_checks(doc, operations))
+        with self.assertRaises(SchemaError):
+            validator.validate(doc, operations, size=1)
+
+
+class TestDriftWatcher(unittest.TestCase):
+    """Test re-applying patches to files that drifted."""
+
+    def setUp(self):
+        """Create two scratch JSON files and a watcher config for them."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.paths = [os.path.join(self.tmpdir, name) for name in ('a.json', 'b.json')]
+        self.write(self.paths[0], {"foo": 1})
+        self.write(self.paths[1], {"items": []})
+        self.marker = os.path.join(self.tmpdir, 'handled')
+        self.config = {"debounce": 0.1, "files": [
+            {"path": self.paths[0], "operations": {"op": "add", "path": "/bar", "value": 2},
+             "handler": "echo a >> %s" % self.marker},
+            {"path": self.paths[1], "operations": [{"op": "test", "path": "/items", "value": []},
+                                                   {"op": "add", "path": "/items/-", "value": 3}]}]}
+
+    def write(self, path, obj):
+        with open(path, 'w') as f:
+            json.dump(obj, f)
+
+    def read(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+    def test_reconcile_reapplies_and_collects_handlers(self):
+        """Test that only drifted files are rewritten and their handlers returned once."""
+        watcher = DriftWatcher(self.config, log=lambda msg: None)
+        self.assertEqual(watcher.reconcile([self.paths[0]]), ["echo a >> %s" % self.marker])
+        self.assertEqual(self.read(self.paths[0]), {"foo": 1, "bar": 2})
+        self.assertEqual(self.read(self.paths[1]), {"items": []})
+        self.assertEqual(watcher.reconcile([self.paths[0]]), [])
+
+    def test_reconcile_skips_own_writes(self):
+        """Test that events caused by the watcher's own write do not patch again."""
+        watcher = DriftWatcher(self.config, log=lambda msg: None)
+        watcher.reconcile([os.path.realpath(self.paths[1])])
+        watcher.reconcile([os.path.realpath(self.paths[1])])
+        self.assertEqual(self.read(self.paths[1]), {"items": [3]})
+
+    def test_reconcile_ignores_metadata_changes(self):
+        """Test that touch and chmod, which change no content, do not re-evaluate the file."""
+        watcher = DriftWatcher(self.config, log=lambda msg: None)
+        path = os.path.realpath(self.paths[1])
+        watcher.reconcile([path])
+        with mock.patch.object(json_patch, 'patch_file', wraps=patch_file) as patched:
+            for mode in (0o640, 0o600, 0o644):
+                os.utime(path)
+                os.chmod(path, mode)
+                watcher.reconcile([path])
+        self.assertEqual(patched.call_count, 0)
+        self.assertEqual(self.read(path), {"items": [3]})
+
+    def test_guarded_append_survives_unrelated_edits(self):
+        """Test that an edit elsewhere in the file does not append again."""
+        watcher = DriftWatcher(self.config, log=lambda msg: None)
+        path = os.path.realpath(self.paths[1])
+        watcher.reconcile([path])
+        self.write(path, {"items": [3], "other": True})
+        watcher.reconcile([path])
+        self.assertEqual(self.read(path), {"items": [3], "other": True})
+
+    def test_config_rejects_unguarded_inserts(self):
+        """Test that appends and index inserts into an array need a test on the array or above it."""
+        for operations in ([{"op": "add", "path": "/items/-", "value": 3}],
+                           [{"op": "add", "path": "/items/0", "value": 3}],
+                           [{"op": "test", "path": "/foo", "value": 1}, {"op": "add", "path": "/items/-", "value": 3}],
+                           [{"op": "test", "path": "/items/0", "value": 3}, {"op": "add", "path": "/items/0", "value": 3}]):
+            with self.assertRaises(ValueError):
+                DriftWatcher({"files": [{"path": self.paths[1], "operations": operations}]})
+        DriftWatcher({"files": [{"path": self.paths[1], "operations": [
+            {"op": "test", "path": "", "value": {"items": []}}, {"op": "add", "path": "/items/-", "value": 3}]}]})
+
+    def test_numeric_object_keys_are_not_inserts(self):
+        """Test that a numeric key of an object is set, not refused as an index insert."""
+        self.write(self.paths[0], {"ports": {}})
+        config = {"files": [{"path": self.paths[0], "operations": {"op": "add", "path": "/ports/8080", "value": "web"}}]}
+        watcher = DriftWatcher(config, log=lambda msg: None)
+        path = os.path.realpath(self.paths[0])
+        watcher.reconcile([path])
+        self.write(path, {"ports": {"8080": "old"}})
+        watcher.reconcile([path])
+        self.assertEqual(self.read(path), {"ports": {"8080": "web"}})
+
+    def test_reconcile_refuses_inserts_once_the_container_is_an_array(self):
+        """Test that a key that became an array is checked again before every re-apply."""
+        self.write(self.paths[1], {"items": {}})
+        logged = []
+        watcher = DriftWatcher({"files": [{"path": self.paths[1], "operations": [
+            {"op": "add", "path": "/items/-", "value": 3}]}]}, log=logged.append)
+        path = os.path.realpath(self.paths[1])
+        for _ in range(3):
+            self.write(path, {"items": [], "edit": len(logged)})
+            watcher.reconcile([path])
+        self.assertEqual(self.read(path)["items"], [])
+        self.assertTrue(all(msg.startswith('refused') for msg in logged))
+
+    def test_config_requires_operations(self):
+        """Test that an entry without operations is rejected."""
+        with self.assertRaises(ValueError):
+            DriftWatcher({"files": [{"path": self.paths[0], "operations": []}]})
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+    def test_cli_watch_restores_drift(self):
+        """Test that the watch command re-patches a file that was replaced."""
+        config = os.path.join(self.tmpdir, 'watch.json')
+        self.write(config, self.config)
+        proc = subprocess.Popen([sys.executable, MODULE_PATH, 'watch', config],
+                                stdout=subprocess.PIPE, text=True)
+        self.addCleanup(proc.stdout.close)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.terminate)
+        self.assertEqual(proc.stdout.readline().strip(), 'watching 2 files')
+
+        def wait_for(predicate):
+            deadline = time.monotonic() + 10
+            while not predicate():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+
+        wait_for(lambda: os.path.exists(self.marker))
+        self.write(self.paths[0], {"foo": "edited"})
+        wait_for(lambda: self.read(self.paths[0]) == {"foo": "edited", "bar": 2})
+        with open(self.marker) as f:
+            wait_for(lambda: f.seek(0) == 0 and f.read().count('a') == 2)
+        self.assertEqual(self.read(self.paths[1]), {"items": [3]})
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+    def test_cli_watch_caps_debounce(self):
+        """Test that a file edited faster than the debounce is still re-patched within max_delay."""
+        config = os.path.join(self.tmpdir, 'watch.json')
+        self.config.update(debounce=0.3, max_delay=0.5)
+        self.write(config, self.config)
+        proc = subprocess.Popen([sys.executable, MODULE_PATH, 'watch', config],
+                                stdout=subprocess.PIPE, text=True)
+        self.addCleanup(proc.stdout.close)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.terminate)
+        self.assertEqual(proc.stdout.readline().strip(), 'watching 2 files')
+        deadline = time.monotonic() + 10
+        while not os.path.exists(self.marker):  # the handler of the initial reconcile
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        reapplied = 0
+        for i in range(30):  # one edit every 0.1s for 3s, never quiet for a whole debounce
+            self.write(self.paths[0], {"foo": i})
+            time.sleep(0.1)
+            with open(self.marker) as f:
+                reapplied = f.read().count('a')
+        self.assertGreaterEqual(reapplied, 3)
+
+
 if __name__ == '__main__':
     unittest.main()
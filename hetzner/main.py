@@ -2,7 +2,10 @@ from __future__ import annotations
 
 import json
 import os
+import sys
+import tempfile
 from dataclasses import dataclass
+from functools import cached_property
 from typing import Literal, get_args
 
 import fire
@@ -10,9 +13,17 @@ from dataclasses_json import dataclass_json
 from hcloud import Client, APIException
 from hcloud.firewalls import FirewallRule
 
+import metrics
+from rule_index import RuleQuery, STDIN_HINT
+from snapshots import SnapshotStore, DEFAULT_SNAPSHOT_DIR
+
 DIRECTIONS = Literal['in', 'out']
 PROTOCOLS = Literal['udp', 'tcp']
 
+API_LATENCY = 'hetzner_api_request_duration_seconds', 'Latency of Hetzner Cloud API calls'
+FIREWALL_RULES = 'hetzner_firewall_rules', 'Number of rules on the firewall'
+FIREWALL_UPDATES = 'hetzner_firewall_updates_total', 'Firewall rule updates by result'
+
 
 @dataclass_json
 @dataclass
@@ -33,8 +44,13 @@ class SerializableRule:
 
 
 class HetznerFirewall:
-    def __init__(self, client: Client, firewall_name='dns-filtered-fw'):
-        self._firewall = client.firewalls.get_by_name(firewall_name)
+    def __init__(self, client: Client, firewall_name='dns-filtered-fw', snapshot_dir=DEFAULT_SNAPSHOT_DIR,
+                 run_metrics: metrics.Metrics | metrics.NullMetrics = metrics.NullMetrics()):
+        self._metrics = run_metrics
+        with self._metrics.time(*API_LATENCY, labels={'call': 'get_firewall'}):
+            self._firewall = client.firewalls.get_by_name(firewall_name)
+        self._metrics.set(*FIREWALL_RULES, len(self._firewall.rules), labels={'firewall': firewall_name})
+        self._snapshots = SnapshotStore(snapshot_dir)
 
     def save(self, dir: str):
         file_path = f'{os.path.join(dir, self._firewall.name)}_rules.json'
@@ -42,6 +58,29 @@ class HetznerFirewall:
         with open(file_path, 'w') as json_file:
             json.dump(list(map(lambda x: x.to_dict(), sr)), json_file)
         print(f'written {len(sr)} rules to {file_path}')
+        self._record_snapshot(sr)
+
+    def snapshot(self):
+        return self._record_snapshot(list(map(lambda r: SerializableRule.from_rule(r), self._firewall.rules)))
+
+    def seen(self, state: str) -> bool:
+        """Whether a rule state was recorded before, given as a digest, a digest prefix or a rules file."""
+        if os.path.isfile(state):
+            return SnapshotStore.digest(list(map(lambda r: r.to_dict(), self._load_rules(state)))) in self._snapshots
+        return bool(self._snapshots.matches(state))
+
+    def history(self):
+        for timestamp, entry in self._snapshots.history(self._firewall.name):
+            kind = 'full' if entry.parent is None else f'delta of {entry.parent[:12]}'
+            print(f'{timestamp} {entry.digest[:12]} {entry.rules} rules ({kind})')
+
+    def restore(self, digest: str, dir: str | None = None):
+        digest = self._snapshots.resolve(digest)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = f'{os.path.join(dir or tmp_dir, self._firewall.name)}_{digest[:12]}_rules.json'
+            self._snapshots.export(digest, file_path)
+            print(f'restoring snapshot {digest[:12]} from {file_path}')
+            self.file_update(file_path)
 
     def merge_update(self, rules_file: str,
                      description: str,
@@ -78,11 +117,17 @@ class HetznerFirewall:
     def _update_rules(self, rules):
         print(f'updating {self._firewall.name} with {len(rules)} rules')
 
+        labels = {'firewall': self._firewall.name}
         try:
-            actions = self._firewall.set_rules(list(map(lambda r: r.to_rule(), rules)))
+            with self._metrics.time(*API_LATENCY, labels={'call': 'set_rules'}):
+                actions = self._firewall.set_rules(list(map(lambda r: r.to_rule(), rules)))
             for action in actions:
                 print(f'{action.command}: {action.status}')
+            self._metrics.set(*FIREWALL_RULES, len(rules), labels=labels)
+            self._metrics.inc(*FIREWALL_UPDATES, labels={**labels, 'result': 'success'})
+            self._record_snapshot(rules)
         except APIException as e:
+            self._metrics.inc(*FIREWALL_UPDATES, labels={**labels, 'result': 'error'})
             print(f'ERROR performing firewall update: {e.code}')
             print(e.message)
             print(e.details)
@@ -92,13 +137,24 @@ class HetznerFirewall:
             json_list = json.load(json_file)
             return list(map(lambda x: SerializableRule.from_dict(x), json_list))
 
+    def _record_snapshot(self, rules: list[SerializableRule]) -> str:
+        digest, created = self._snapshots.add(self._firewall.name, list(map(lambda r: r.to_dict(), rules)))
+        print(f'{"recorded new" if created else "already seen"} snapshot {digest[:12]} of {len(rules)} rules')
+        return digest
 
 
 class HetznerServer:
     def __init__(self):
         self._client = Client(token=os.getenv('API_TOKEN'))
-        self.firewall = HetznerFirewall(self._client)
+        self._metrics = metrics.from_env('hetzner_firewall')
+        self.rules = RuleQuery()
+
+    @cached_property
+    def firewall(self) -> HetznerFirewall:
+        return HetznerFirewall(self._client, run_metrics=self._metrics)
 
 
 if __name__ == '__main__':
+    if '-' in sys.argv[1:]:  # no command here is chained, so a separator only ever swallows options
+        sys.exit(STDIN_HINT)
     fire.Fire(HetznerServer)
@@ -0,0 +1,251 @@
+from __future__ import annotations
+
+import atexit
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import re
+import socket
+import tempfile
+import time
+import urllib.request
+from contextlib import contextmanager, nullcontext
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEFAULT_STATE_DIR = os.getenv('METRICS_STATE_DIR', os.path.expanduser('~/.local/state/servyy/metrics'))
+
+Labels = tuple[tuple[str, str], ...]
+# name -> [type, help, {(sample name, escaped labels): value}]
+Families = dict[str, list]
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+_LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def _labels(labels: dict[str, str] | None) -> Labels:
+    return tuple(sorted((labels or {}).items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def parse_exposition(text: str) -> Families:
+    families: Families = {}
+    family = None
+    for line in text.splitlines():
+        if line.startswith(('# HELP ', '# TYPE ')):
+            name, _, rest = line[7:].partition(' ')
+            family = families.setdefault(name, [None, '', {}])
+            family[0 if line[2] == 'T' else 1] = rest
+        elif line and not line.startswith('#') and family is not None and (match := _SAMPLE.match(line)):
+            family[2][(match.group(1), tuple(_LABEL.findall(match.group(2) or '')))] = float(match.group(3))
+    return families
+
+
+def merge_exposition(totals: Families, run: Families) -> Families:
+    """Add `run` to `totals`: counters and histograms accumulate, gauges are replaced."""
+    for name, (metric_type, help_text, samples) in run.items():
+        family = totals.setdefault(name, [metric_type, help_text, {}])
+        family[0], family[1] = metric_type, help_text
+        for key, value in samples.items():
+            family[2][key] = value if metric_type == 'gauge' else family[2].get(key, 0) + value
+    return totals
+
+
+def render_exposition(families: Families, labels: Labels = ()) -> str:
+    """Render parsed families with `labels` added to every sample."""
+    extra = tuple((k, _escape(v)) for k, v in labels)
+    lines = []
+    for name, (metric_type, help_text, samples) in families.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for (sample, sample_labels), value in samples.items():
+            pairs = extra + sample_labels
+            rendered = '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}' if pairs else ''
+            lines.append(f'{sample}{rendered} {int(value) if value == int(value) else value!r}')
+    return '\n'.join(lines) + '\n'
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Metrics of a single run, pushed to a Pushgateway or written as a node-exporter textfile.
+
+    Prometheus text exposition is rendered by hand, as the shell probes in
+    ansible/plays/roles/system_probe do, so no client library is needed.
+    flush() adds the run to the totals kept in `state_dir` for its grouping
+    (which always includes the host as `instance`), so counters and
+    histograms are cumulative across runs and rate() over them is meaningful.
+    """
+
+    enabled = True
+
+    def __init__(self, job: str, pushgateway: str | None = None, textfile: str | None = None,
+                 grouping: dict[str, str] | None = None, state_dir: str = DEFAULT_STATE_DIR):
+        self._job = job
+        self._pushgateway = pushgateway
+        self._textfile = textfile
+        self._grouping = {'instance': socket.gethostname(), **(grouping or {})}
+        self._state_dir = state_dir
+        self._help: dict[str, tuple[str, str]] = {}
+        self._values: dict[str, dict[Labels, float | _Histogram]] = {}
+
+    def inc(self, name: str, help_text: str, labels: dict[str, str] | None = None, value: float = 1):
+        series = self._series(name, 'counter', help_text)
+        key = _labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, help_text: str, value: float, labels: dict[str, str] | None = None):
+        self._series(name, 'gauge', help_text)[_labels(labels)] = value
+
+    def observe(self, name: str, help_text: str, value: float, labels: dict[str, str] | None = None,
+                buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        series = self._series(name, 'histogram', help_text)
+        key = _labels(labels)
+        if key not in series:
+            series[key] = _Histogram(buckets)
+        series[key].observe(value)
+
+    @contextmanager
+    def time(self, name: str, help_text: str, labels: dict[str, str] | None = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, help_text, time.perf_counter() - start, labels)
+
+    def render(self) -> str:
+        lines = []
+        for name, (metric_type, help_text) in self._help.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in self._values[name].items():
+                if isinstance(value, _Histogram):
+                    for bound, count in zip(value.buckets, value.counts):
+                        lines.append(f'{name}_bucket{_format_labels(labels + (("le", repr(bound)),))} {count}')
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {value.count}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {value.sum!r}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {value.count}')
+                else:
+                    lines.append(f'{name}{_format_labels(labels)} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+    def flush(self) -> str | None:
+        """Add the run to its group's totals, push them, falling back to the textfile. Returns an error, if any."""
+        digest = hashlib.sha256(json.dumps(sorted(self._grouping.items())).encode()).hexdigest()
+        group = f'{self._job}-{digest[:16]}.prom'
+        os.makedirs(self._state_dir, exist_ok=True)
+        state = os.path.join(self._state_dir, group)
+        with open(os.path.join(self._state_dir, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            totals = {}
+            if os.path.exists(state):
+                with open(state) as fh:
+                    totals = parse_exposition(fh.read())
+            totals = merge_exposition(totals, parse_exposition(self.render()))
+            payload = render_exposition(totals)
+            _write(state, payload)
+
+        textfile = self._textfile
+        if textfile and not textfile.endswith('.prom'):
+            textfile = os.path.join(textfile, group)
+        error = None
+        if self._pushgateway:
+            try:
+                request = urllib.request.Request(self._push_url(), data=payload.encode(), method='POST',
+                                                 headers={'Content-Type': 'text/plain; version=0.0.4'})
+                urllib.request.urlopen(request, timeout=5).close()
+                if textfile and os.path.exists(textfile):  # a stale fallback would be scraped as well
+                    os.unlink(textfile)
+                return None
+            except OSError as e:
+                error = f'could not push metrics to {self._pushgateway}: {e}'
+        if textfile:
+            # node-exporter adds `instance` itself
+            _write(textfile, render_exposition(totals, tuple(
+                (k, v) for k, v in sorted(self._grouping.items()) if k != 'instance')))
+        return error
+
+    def _push_url(self) -> str:
+        url = f'{self._pushgateway.rstrip("/")}/metrics/job/{self._job}'
+        for key, value in sorted(self._grouping.items()):
+            encoded = base64.urlsafe_b64encode(str(value).encode()).decode().rstrip('=') or '='
+            url += f'/{key}@base64/{encoded}'
+        return url
+
+    def _series(self, name: str, metric_type: str, help_text: str) -> dict:
+        if name not in self._help:
+            self._help[name] = (metric_type, help_text)
+            self._values[name] = {}
+        return self._values[name]
+
+
+def _write(path: str, text: str):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(text)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+class NullMetrics:
+    """Stand-in used when metrics are disabled; every call is a no-op."""
+
+    enabled = False
+
+    def inc(self, *args, **kwargs):
+        pass
+
+    def set(self, *args, **kwargs):
+        pass
+
+    def observe(self, *args, **kwargs):
+        pass
+
+    def time(self, *args, **kwargs):
+        return nullcontext()
+
+    def flush(self):
+        return None
+
+
+def from_env(job: str) -> Metrics | NullMetrics:
+    """Enable metrics when METRICS_PUSHGATEWAY or METRICS_TEXTFILE is set; flushed at exit.
+
+    Totals are kept in METRICS_STATE_DIR (default ``~/.local/state/servyy/metrics``).
+    """
+    pushgateway = os.getenv('METRICS_PUSHGATEWAY')
+    textfile = os.getenv('METRICS_TEXTFILE')
+    if not pushgateway and not textfile:
+        return NullMetrics()
+    metrics = Metrics(job, pushgateway=pushgateway, textfile=textfile)
+
+    def _flush():
+        error = metrics.flush()
+        if error:
+            print(f'WARNING {error}')
+
+    atexit.register(_flush)
+    return metrics
@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import ipaddress
+import json
+import sys
+import time
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Iterable
+
+ANY_PORT = (0, 65535)
+
+
+@dataclass(frozen=True)
+class IndexedRule:
+    file: str
+    position: int
+    direction: str
+    protocol: str
+    ports: tuple[int, int]
+    networks: tuple[ipaddress.IPv4Network | ipaddress.IPv6Network, ...]
+    description: str | None
+
+    def __str__(self):
+        return f'{self.description or "<no description>"} ({self.file}#{self.position})'
+
+
+def _parse_port(port) -> tuple[int, int]:
+    if isinstance(port, (list, tuple)):  # tolerate rules written with a tuple default
+        port = port[0] if port else None
+    if port is None or str(port) in ('', 'None', 'any'):
+        return ANY_PORT
+    low, _, high = str(port).partition('-')
+    return int(low), int(high or low)
+
+
+class _AddressTable:
+    """Disjoint address segments, each mapped to the rules covering it.
+
+    Built by sweeping over the start and end of every network, so a lookup is a
+    single bisect over the segment boundaries.
+    """
+
+    def __init__(self, entries: Iterable[tuple[int, int, int]]):
+        events: dict[int, list[tuple[int, int]]] = {}
+        for start, end, rule_id in entries:
+            events.setdefault(start, []).append((1, rule_id))
+            events.setdefault(end + 1, []).append((-1, rule_id))
+        active: dict[int, int] = {}
+        self._bounds: list[int] = []
+        self._segments: list[tuple[int, ...]] = []
+        for bound in sorted(events):
+            for delta, rule_id in events[bound]:
+                active[rule_id] = active.get(rule_id, 0) + delta
+                if not active[rule_id]:
+                    del active[rule_id]
+            self._bounds.append(bound)
+            self._segments.append(tuple(sorted(active)))
+
+    def lookup(self, address: int) -> tuple[int, ...]:
+        i = bisect_right(self._bounds, address) - 1
+        return self._segments[i] if i >= 0 else ()
+
+
+class RuleIndex:
+    """Answer "which rule allows this address" over one or more saved rule files.
+
+    Rules are grouped per direction and protocol, then per port range; each
+    group keeps one address table per IP version.
+    """
+
+    def __init__(self, rules_files: Iterable[str], exclude: Iterable[str] = ()):
+        excluded = set(exclude)
+        self.rules: list[IndexedRule] = []
+        for rules_file in rules_files:
+            with open(rules_file, 'r') as json_file:
+                for position, rule in enumerate(json.load(json_file)):
+                    if rule.get('description') in excluded:
+                        continue
+                    ips = rule['source_ips'] if rule['direction'] == 'in' else rule.get('destination_ips')
+                    self.rules.append(IndexedRule(
+                        file=rules_file, position=position, direction=rule['direction'], protocol=rule['protocol'],
+                        ports=_parse_port(rule.get('port')),
+                        networks=tuple(ipaddress.ip_network(ip, strict=False) for ip in ips or ()),
+                        description=rule.get('description')))
+
+        grouped: dict[tuple[str, str, tuple[int, int]], list[int]] = {}
+        for rule_id, rule in enumerate(self.rules):
+            grouped.setdefault((rule.direction, rule.protocol, rule.ports), []).append(rule_id)
+        self._tables: dict[tuple[str, str], list[tuple[tuple[int, int], dict[int, _AddressTable]]]] = {}
+        for (direction, protocol, ports), rule_ids in grouped.items():
+            tables = {version: _AddressTable(
+                (int(net.network_address), int(net.broadcast_address), rule_id)
+                for rule_id in rule_ids for net in self.rules[rule_id].networks if net.version == version)
+                for version in (4, 6)}
+            self._tables.setdefault((direction, protocol), []).append((ports, tables))
+
+    def query(self, address: str, port: int | None = None, protocol: str = 'tcp',
+              direction: str = 'in') -> list[IndexedRule]:
+        ip = ipaddress.ip_address(address)
+        matched: set[int] = set()
+        for (low, high), tables in self._tables.get((direction, protocol), ()):
+            if port is None or low <= port <= high:
+                matched.update(tables[ip.version].lookup(int(ip)))
+        return [self.rules[rule_id] for rule_id in sorted(matched)]
+
+    def redundant(self) -> list[tuple[IndexedRule, str]]:
+        """Report rules and networks that do not widen what the rule set allows."""
+        findings = []
+        seen: dict[tuple, IndexedRule] = {}
+        removable: set[int] = set()
+        for rule_id, rule in enumerate(self.rules):
+            signature = (rule.direction, rule.protocol, rule.ports, frozenset(rule.networks))
+            if signature in seen:
+                findings.append((rule, f'duplicate of {seen[signature]}'))
+                removable.add(rule_id)
+            else:
+                seen[signature] = rule
+
+        for rule_id, rule in enumerate(self.rules):
+            if rule_id in removable:
+                continue
+
+            for net in rule.networks:
+                if any(other != net and net.version == other.version and net.subnet_of(other)
+                       for other in rule.networks):
+                    findings.append((rule, f'{net} is contained in another network of the same rule'))
+
+            # rules already reported for removal cannot cover anything, or removing all findings drops access
+            covering = [other for other_id, other in enumerate(self.rules)
+                        if other_id != rule_id and other_id not in removable and other.direction == rule.direction
+                        and other.protocol == rule.protocol
+                        and other.ports[0] <= rule.ports[0] and rule.ports[1] <= other.ports[1]]
+            if rule.networks and covering:
+                union = {version: list(ipaddress.collapse_addresses(
+                    net for other in covering for net in other.networks if net.version == version))
+                    for version in (4, 6)}
+                if all(any(net.subnet_of(block) for block in union[net.version]) for net in rule.networks):
+                    findings.append((rule, f'shadowed by {", ".join(str(other) for other in covering)}'))
+                    removable.add(rule_id)
+        return findings
+
+
+# fire takes a bare `-` as its command separator and drops the options after it
+STDIN_HINT = '"-" is not accepted: omit the addresses or pass --stdin to read them from stdin'
+
+
+class RuleQuery:
+    """Query saved rule files without talking to the Hetzner API."""
+
+    def allowed(self, rules_files: str | list[str], addresses: str | list[str] | None = None, port: int | None = None,
+                protocol: str = 'tcp', direction: str = 'in', exclude: list[str] = (), stdin: bool = False):
+        """Print the rules allowing each address; without addresses (or with ``--stdin``) they are read from stdin.
+
+        ``exclude`` drops rules by description to answer what-if questions.
+        """
+        if addresses == '-' or (not isinstance(addresses, str) and addresses is not None and '-' in addresses):
+            raise ValueError(STDIN_HINT)
+        index = RuleIndex(_as_list(rules_files), exclude=_as_list(exclude))
+        addresses = _as_list(addresses or [])
+        if stdin or not addresses:
+            addresses = [line.strip() for line in sys.stdin if line.strip()] + addresses
+
+        start = time.perf_counter()
+        results = [(address, index.query(address, port=port, protocol=protocol, direction=direction))
+                   for address in addresses]
+        elapsed = time.perf_counter() - start
+
+        for address, rules in results:
+            print(f'{address} ALLOW {"; ".join(map(str, rules))}' if rules else f'{address} DENY')
+        print(f'{len(addresses)} queries over {len(index.rules)} rules in {elapsed * 1000:.2f}ms '
+              f'({elapsed * 1e6 / max(len(addresses), 1):.1f}us each)', file=sys.stderr)
+
+    def redundant(self, rules_files: str | list[str]):
+        """Print shadowed, duplicate and self-overlapping rules."""
+        index = RuleIndex(_as_list(rules_files))
+        findings = index.redundant()
+        for rule, reason in findings:
+            print(f'{rule}: {reason}')
+        print(f'{len(findings)} findings in {len(index.rules)} rules', file=sys.stderr)
+
+
+def _as_list(value) -> list:
+    if isinstance(value, str):
+        return [value]
+    return list(value)
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+
+DEFAULT_SNAPSHOT_DIR = os.getenv('FIREWALL_SNAPSHOT_DIR',
+                                 os.path.expanduser('~/.local/state/servyy/firewall-snapshots'))
+
+
+def _canonical(rule: dict) -> str:
+    return json.dumps(rule, sort_keys=True, separators=(',', ':'))
+
+
+def _rule_key(canonical_rule: str) -> str:
+    return hashlib.sha256(canonical_rule.encode()).hexdigest()[:16]
+
+
+def _write_atomic(path: str, data: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@dataclass
+class SnapshotEntry:
+    digest: str
+    parent: str | None
+    depth: int
+    rules: int
+    created: float
+
+
+class SnapshotStore:
+    """Content-addressed store of firewall rule sets.
+
+    Every rule set is keyed by the sha256 of its canonical (sorted) rules, so a
+    state that was seen before is never written again. New states are stored as
+    a delta (added rules, removed rule keys) against the previous state of the
+    same firewall; every ``full_every`` links the chain is cut with a full copy
+    to keep restores short.
+
+    Layout below ``root``::
+
+        index.json          digest -> parent, depth, rule count, creation time
+        objects/ab/cd...    full rule list or delta (added rules by key, removed keys) against parent
+        refs/<firewall>     digest of the latest state
+        logs/<firewall>     "<timestamp> <digest>" per recorded state
+    """
+
+    def __init__(self, root: str = DEFAULT_SNAPSHOT_DIR, full_every: int = 16):
+        self._root = root
+        self._full_every = full_every
+        self._index_path = os.path.join(root, 'index.json')
+        self._index: dict[str, SnapshotEntry] = {}
+        self._cache: dict[str, dict[str, dict]] = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, 'r') as index_file:
+                self._index = {digest: SnapshotEntry(digest=digest, **entry)
+                               for digest, entry in json.load(index_file).items()}
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @staticmethod
+    def digest(rules: list[dict]) -> str:
+        canonical_rules = sorted(_canonical(r) for r in rules)
+        return hashlib.sha256('\n'.join(canonical_rules).encode()).hexdigest()
+
+    def matches(self, prefix: str) -> list[str]:
+        if prefix in self._index:
+            return [prefix]
+        return [digest for digest in self._index if digest.startswith(prefix)] if prefix else []
+
+    def resolve(self, prefix: str) -> str:
+        matches = self.matches(prefix)
+        if len(matches) != 1:
+            raise KeyError(f'snapshot prefix {prefix} matches {len(matches)} snapshots')
+        return matches[0]
+
+    def head(self, name: str) -> str | None:
+        ref_path = os.path.join(self._root, 'refs', name)
+        if not os.path.exists(ref_path):
+            return None
+        with open(ref_path, 'r') as ref_file:
+            return ref_file.read().strip() or None
+
+    def add(self, name: str, rules: list[dict]) -> tuple[str, bool]:
+        """Record ``rules`` as the current state of firewall ``name``.
+
+        Returns the snapshot digest and whether a new object was written.
+        """
+        digest = self.digest(rules)
+        created = digest not in self._index
+        parent = self.head(name)
+        if created:
+            keyed = self._keyed(rules)
+            if parent is None or self._index[parent].depth + 1 >= self._full_every:
+                obj = {'parent': None, 'rules': list(keyed.values())}
+                entry = SnapshotEntry(digest=digest, parent=None, depth=0, rules=len(keyed), created=time.time())
+            else:
+                parent_rules = self._materialize(parent)
+                obj = {'parent': parent,
+                       'added': {key: rule for key, rule in keyed.items() if key not in parent_rules},
+                       'removed': [key for key in parent_rules if key not in keyed]}
+                entry = SnapshotEntry(digest=digest, parent=parent, depth=self._index[parent].depth + 1,
+                                      rules=len(keyed), created=time.time())
+            _write_atomic(self._object_path(digest), json.dumps(obj))
+            self._index[digest] = entry
+            self._cache[digest] = keyed
+            self._write_index()
+        if parent != digest:
+            _write_atomic(os.path.join(self._root, 'refs', name), digest)
+            os.makedirs(os.path.join(self._root, 'logs'), exist_ok=True)
+            with open(os.path.join(self._root, 'logs', name), 'a') as log_file:
+                log_file.write(f'{int(time.time())} {digest}\n')
+        return digest, created
+
+    def load(self, digest: str) -> list[dict]:
+        return list(self._materialize(self.resolve(digest)).values())
+
+    def export(self, digest: str, file_path: str) -> str:
+        """Write the rules of snapshot ``digest`` as a rules file usable by ``file_update``."""
+        rules = self.load(digest)
+        _write_atomic(os.path.abspath(file_path), json.dumps(rules))
+        return file_path
+
+    def history(self, name: str) -> list[tuple[int, SnapshotEntry]]:
+        log_path = os.path.join(self._root, 'logs', name)
+        if not os.path.exists(log_path):
+            return []
+        with open(log_path, 'r') as log_file:
+            lines = [line.split() for line in log_file if line.strip()]
+        return [(int(timestamp), self._index[digest]) for timestamp, digest in lines if digest in self._index]
+
+    def _materialize(self, digest: str) -> dict[str, dict]:
+        chain = []
+        current = digest
+        while current not in self._cache:
+            with open(self._object_path(current), 'r') as object_file:
+                obj = json.load(object_file)
+            chain.append((current, obj))
+            if obj['parent'] is None:
+                break
+            current = obj['parent']
+        keyed: dict[str, dict] = {}
+        if current in self._cache:
+            keyed = dict(self._cache[current])
+        for chain_digest, obj in reversed(chain):
+            if obj['parent'] is None:
+                keyed = self._keyed(obj['rules'])
+            else:
+                for key in obj['removed']:
+                    keyed.pop(key, None)
+                added = obj['added']
+                keyed.update(added if isinstance(added, dict) else self._keyed(added))
+                keyed = dict(sorted(keyed.items(), key=lambda item: item[0]))
+            self._cache[chain_digest] = dict(keyed)
+        return self._cache[digest]
+
+    @staticmethod
+    def _keyed(rules: list[dict]) -> dict[str, dict]:
+        """Key rules by content hash; repeated copies of a rule get ``<hash>.<n>`` keys."""
+        keyed: dict[str, dict] = {}
+        seen: dict[str, int] = {}
+        for rule in rules:
+            key = _rule_key(_canonical(rule))
+            occurrence = seen.get(key, 0)
+            seen[key] = occurrence + 1
+            keyed[f'{key}.{occurrence}' if occurrence else key] = rule
+        return dict(sorted(keyed.items(), key=lambda item: item[0]))
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self._root, 'objects', digest[:2], digest[2:])
+
+    def _write_index(self):
+        _write_atomic(self._index_path, json.dumps(
+            {digest: {'parent': entry.parent, 'depth': entry.depth, 'rules': entry.rules, 'created': entry.created}
+             for digest, entry in self._index.items()}))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Unit tests for the firewall command line."""
+
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+# Add parent directory to path for importing main
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HAS_DEPS = all(importlib.util.find_spec(name) for name in ('fire', 'hcloud', 'dataclasses_json'))
+
+
+@unittest.skipUnless(HAS_DEPS, 'needs fire, hcloud and dataclasses_json')
+class TestSeen(unittest.TestCase):
+    """Test asking whether a rule state was recorded before."""
+
+    def setUp(self):
+        """Record one snapshot of a firewall served by a fake client."""
+        from hcloud.firewalls import FirewallRule
+        from main import HetznerFirewall
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        rules = [FirewallRule(direction='in', protocol='tcp', port=port, source_ips=['10.0.0.0/8'], description=port)
+                 for port in ('22', '80')]
+        client = mock.Mock()
+        client.firewalls.get_by_name.return_value = SimpleNamespace(name='fw', rules=rules)
+        self.firewall = HetznerFirewall(client, 'fw', snapshot_dir=os.path.join(self.tmpdir, 'snapshots'))
+        with mock.patch('builtins.print'):
+            self.digest = self.firewall.snapshot()
+            self.firewall.save(self.tmpdir)
+
+    def test_printed_prefix_is_seen(self):
+        """Test that the 12-character digests printed by save, snapshot and history work."""
+        self.assertTrue(self.firewall.seen(self.digest[:12]))
+        self.assertTrue(self.firewall.seen(self.digest))
+        self.assertFalse(self.firewall.seen('0' * 12 if not self.digest.startswith('0') else 'f' * 12))
+        self.assertFalse(self.firewall.seen(''))
+
+    def test_rules_file_is_seen(self):
+        """Test that a rules file is looked up by the digest of its rules, in any order."""
+        path = os.path.join(self.tmpdir, 'fw_rules.json')
+        self.assertTrue(self.firewall.seen(path))
+        with open(path) as f:
+            rules = json.load(f)
+        other = os.path.join(self.tmpdir, 'other.json')
+        for variant, seen in ((rules[::-1], True), (rules + [dict(rules[0], port='443')], False)):
+            with open(other, 'w') as f:
+                json.dump(variant, f)
+            self.assertEqual(self.firewall.seen(other), seen)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Unit tests for run metrics."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Add parent directory to path for importing metrics
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """Test that flushed metrics add up across runs."""
+
+    def setUp(self):
+        """Create scratch textfile and state directories."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.state = os.path.join(self.tmpdir, 'state')
+
+    def run_once(self, rules, result, grouping=None):
+        metrics = Metrics('hetzner_firewall', pushgateway='http://127.0.0.1:1', textfile=self.tmpdir,
+                          grouping=grouping, state_dir=self.state)
+        metrics.set('hetzner_firewall_rules', 'rules', rules, labels={'firewall': 'fw'})
+        metrics.inc('hetzner_firewall_updates_total', 'updates', labels={'firewall': 'fw', 'result': result})
+        metrics.observe('hetzner_api_latency_seconds', 'latency', 0.02, labels={'call': 'set_rules'})
+        self.assertIn('could not push metrics', metrics.flush())
+
+    def textfiles(self):
+        found = {}
+        for name in sorted(os.listdir(self.tmpdir)):
+            if name.endswith('.prom'):
+                with open(os.path.join(self.tmpdir, name)) as fh:
+                    found[name] = fh.read()
+        return found
+
+    def test_counters_accumulate_and_gauges_are_replaced(self):
+        """Test that the textfile holds totals over all runs, not the last run's increments."""
+        self.run_once(10, 'success')
+        self.run_once(12, 'success')
+        self.run_once(12, 'error')
+        [text] = self.textfiles().values()
+        self.assertIn('hetzner_firewall_updates_total{firewall="fw",result="success"} 2\n', text)
+        self.assertIn('hetzner_firewall_updates_total{firewall="fw",result="error"} 1\n', text)
+        self.assertIn('hetzner_firewall_rules{firewall="fw"} 12\n', text)
+        self.assertIn('hetzner_api_latency_seconds_count{call="set_rules"} 3\n', text)
+        self.assertIn('hetzner_api_latency_seconds_bucket{call="set_rules",le="0.025"} 3\n', text)
+
+    def test_groups_get_their_own_file_and_labels(self):
+        """Test that differently grouped runs neither overwrite nor mix with each other."""
+        self.run_once(10, 'success', grouping={'project': 'a'})
+        self.run_once(20, 'success', grouping={'project': 'b'})
+        texts = list(self.textfiles().values())
+        self.assertEqual(len(texts), 2)
+        self.assertTrue(any('hetzner_firewall_rules{project="a",firewall="fw"} 10\n' in text for text in texts))
+        self.assertTrue(all('instance=' not in text for text in texts))
+
+
+if __name__ == '__main__':
+    unittest.main()
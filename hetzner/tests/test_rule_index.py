@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Unit tests for offline rule queries."""
+
+import json
+import os
+import importlib.util
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# Add parent directory to path for importing rule_index
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rule_index import RuleIndex
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+HAS_CLI_DEPS = all(importlib.util.find_spec(name) for name in ('fire', 'hcloud', 'dataclasses_json'))
+
+
+def rule(description, ips, port='22'):
+    return {'direction': 'in', 'protocol': 'tcp', 'port': port, 'source_ips': ips, 'description': description}
+
+
+class TestRuleIndex(unittest.TestCase):
+    """Test lookups and redundancy reports over saved rule files."""
+
+    def setUp(self):
+        """Create a scratch directory for rule files."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def index(self, rules):
+        path = os.path.join(self.tmpdir, 'rules.json')
+        with open(path, 'w') as f:
+            json.dump(rules, f)
+        return RuleIndex([path])
+
+    def assert_removal_keeps_access(self, index, address):
+        removed = {rule.position for rule, _ in index.redundant()}
+        self.assertTrue(any(rule.position not in removed for rule in index.query(address, port=22)))
+
+    def test_query(self):
+        """Test that lookups honour networks and port ranges."""
+        index = self.index([rule('office', ['10.0.0.0/8']), rule('web', ['0.0.0.0/0'], port='80-443')])
+        self.assertEqual([r.description for r in index.query('10.1.2.3', port=22)], ['office'])
+        self.assertEqual([r.description for r in index.query('192.0.2.1', port=443)], ['web'])
+        self.assertEqual(index.query('192.0.2.1', port=22), [])
+
+    def test_duplicates_are_not_also_shadowed(self):
+        """Test that of two identical rules only the second is reported."""
+        index = self.index([rule('a', ['10.0.0.0/8']), rule('b', ['10.0.0.0/8'])])
+        self.assertEqual([(r.description, reason.split()[0]) for r, reason in index.redundant()], [('b', 'duplicate')])
+        self.assert_removal_keeps_access(index, '10.1.2.3')
+
+    def test_mutually_covering_rules_keep_one(self):
+        """Test that rules covering each other are not all reported as shadowed."""
+        index = self.index([rule('a', ['10.0.0.0/8']), rule('b', ['10.0.0.0/9', '10.128.0.0/9'])])
+        self.assertEqual([r.description for r, _ in index.redundant()], ['a'])
+        self.assert_removal_keeps_access(index, '10.1.2.3')
+
+
+@unittest.skipUnless(HAS_CLI_DEPS, 'needs fire, hcloud and dataclasses_json')
+class TestRulesCli(unittest.TestCase):
+    """Test `main.py rules allowed` as it is run from the shell."""
+
+    def setUp(self):
+        """Write a rule file that only allows DNS."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.rules = os.path.join(self.tmpdir, 'rules.json')
+        with open(self.rules, 'w') as f:
+            json.dump([rule('dns', ['0.0.0.0/0'], port='53')], f)
+
+    def allowed(self, *args, stdin=''):
+        return subprocess.run([sys.executable, MAIN, 'rules', 'allowed', self.rules, *args], input=stdin,
+                              capture_output=True, text=True, timeout=60, check=False)
+
+    def test_addresses_from_stdin_honour_options(self):
+        """Test that omitted addresses are read from stdin and the options after them still apply."""
+        proc = self.allowed('--port=22', stdin='10.1.2.3\n192.0.2.1\n')
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertEqual(proc.stdout.splitlines(), ['10.1.2.3 DENY', '192.0.2.1 DENY'])
+        proc = self.allowed('192.0.2.1', '--stdin', '--port=53', stdin='10.1.2.3\n')
+        self.assertEqual(proc.stdout.splitlines()[0], '10.1.2.3 ALLOW dns (%s#0)' % self.rules)
+        self.assertEqual(len(proc.stdout.splitlines()), 2)
+
+    def test_dash_is_refused(self):
+        """Test that `-`, which fire takes as its separator, is an error rather than a query without a port."""
+        proc = self.allowed('-', '--port=22', stdin='10.1.2.3\n')
+        self.assertNotEqual(proc.returncode, 0)
+        self.assertNotIn('ALLOW', proc.stdout)
+        self.assertIn('--stdin', proc.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
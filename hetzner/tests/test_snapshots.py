@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Unit tests for the firewall snapshot store."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Add parent directory to path for importing snapshots
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snapshots import SnapshotStore
+
+
+def rule(port, ips=('10.0.0.0/8',)):
+    return {'direction': 'in', 'protocol': 'tcp', 'port': str(port), 'source_ips': list(ips),
+            'description': f'port {port}'}
+
+
+class TestSnapshotStore(unittest.TestCase):
+    """Test recording and restoring rule sets."""
+
+    def setUp(self):
+        """Create a scratch store directory."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_round_trip_over_delta_chains(self):
+        """Test that every recorded state restores exactly, from a fresh store and across full copies."""
+        store = SnapshotStore(self.tmpdir, full_every=3)
+        states = [
+            [rule(22)],
+            [rule(22), rule(80)],
+            [rule(80), rule(443)],
+            [rule(80), rule(443), rule(443)],
+            [rule(443)],
+            [rule(22, ('0.0.0.0/0',)), rule(443), rule(443), rule(443)],
+            [rule(22)],
+        ]
+        digests = [store.add('fw', rules)[0] for rules in states]
+        self.assertEqual(digests[0], digests[-1])
+        self.assertEqual([store._index[d].depth for d in digests[:6]], [0, 1, 2, 0, 1, 2])
+
+        reopened = SnapshotStore(self.tmpdir, full_every=3)
+        for digest, rules in zip(digests, states):
+            restored = reopened.load(digest)
+            self.assertEqual(SnapshotStore.digest(restored), digest)
+            self.assertEqual(len(restored), reopened._index[digest].rules)
+            self.assertEqual(sorted(map(str, restored)), sorted(map(str, rules)))
+        self.assertEqual([entry.digest for _, entry in reopened.history('fw')], digests)
+        self.assertEqual(reopened.head('fw'), digests[-1])
+
+    def test_seen_state_is_not_stored_again(self):
+        """Test that recording a known state only moves the firewall's head."""
+        store = SnapshotStore(self.tmpdir)
+        digest, created = store.add('fw', [rule(22)])
+        self.assertTrue(created)
+        self.assertEqual(store.add('other', [rule(22)]), (digest, False))
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.resolve(digest[:8]), digest)
+
+
+if __name__ == '__main__':
+    unittest.main()
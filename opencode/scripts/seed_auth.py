@@ -1,44 +1,140 @@
 #!/usr/bin/env python3
-"""Seed the Antigravity (Google) OAuth credential into OpenCode's auth.json.
+"""Seed provider credentials into OpenCode's auth.json.
 
-Reads the base64-encoded ``{"google": {...}}`` blob from the
-OPENCODE_AUTH_GOOGLE_B64 environment variable and merges it into
-``$AUTH_DIR/auth.json``. Idempotent: never clobbers a ``google`` entry that
-OpenCode may have refreshed on a previous boot (the volume is persisted).
+Seeds come from every ``OPENCODE_AUTH_<PROVIDER>_B64`` environment variable
+(base64 of ``{"<provider>": {...}}``, e.g. OPENCODE_AUTH_GOOGLE_B64 for the
+Antigravity OAuth credential) and, optionally, from a plain JSON manifest
+``{"<provider>": {...}, ...}`` at ``$OPENCODE_AUTH_MANIFEST``. All of them are
+merged into ``$AUTH_DIR/auth.json`` in a single locked read-merge-write pass.
+Idempotent: never clobbers a provider entry that OpenCode may have refreshed on
+a previous boot (the volume is persisted).
 
-Prints ``seeded`` or ``present`` for the caller to log. Exits 0 on no-op.
+The write is atomic (temp file, fsync, rename). A hash of the applied seeds,
+together with auth.json's inode, mtime and size, is kept next to auth.json, so
+a boot with unchanged seeds and an untouched auth.json returns after a single
+stat(). Any change to auth.json (e.g. a crash mid-write) re-runs the merge; an
+unparsable auth.json is moved aside, not discarded.
+
+Prints ``seeded <providers>``, ``present`` or ``unchanged`` for the caller to
+log. Exits 0 on no-op.
 """
 import base64
+import fcntl
+import hashlib
 import json
 import os
 import sys
+import tempfile
+import time
+
+ENV_PREFIX = "OPENCODE_AUTH_"
+ENV_SUFFIX = "_B64"
+
 
-blob = os.environ.get("OPENCODE_AUTH_GOOGLE_B64")
-if not blob:
-    sys.exit(0)
+def seed_sources():
+    """Return the raw seed blobs as sorted ``(source, bytes)`` pairs."""
+    sources = [
+        (name, value.encode())
+        for name, value in os.environ.items()
+        if name.startswith(ENV_PREFIX) and name.endswith(ENV_SUFFIX) and value
+    ]
+    manifest = os.environ.get("OPENCODE_AUTH_MANIFEST")
+    if manifest and os.path.exists(manifest):
+        with open(manifest, "rb") as fh:
+            sources.append(("manifest", fh.read()))
+    return sorted(sources)
 
-auth_dir = os.environ.get("AUTH_DIR") or os.path.join(
-    os.environ.get("HOME", "/root"), ".local", "share", "opencode"
-)
-path = os.path.join(auth_dir, "auth.json")
 
-seed = json.loads(base64.b64decode(blob))
+def decode(source, raw):
+    if source == "manifest":
+        return json.loads(raw)
+    return json.loads(base64.b64decode(raw))
 
-data = {}
-if os.path.exists(path):
+
+def write_atomic(path, data, mode=0o600):
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".%s." % os.path.basename(path))
+    try:
+        with os.fdopen(fd, "w") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def load_existing(path):
     try:
         with open(path) as fh:
-            data = json.load(fh)
-    except Exception:
-        data = {}
-
-if "google" in data:
-    print("present")
-    sys.exit(0)
-
-data.update(seed)
-os.makedirs(auth_dir, exist_ok=True)
-with open(path, "w") as fh:
-    json.dump(data, fh)
-os.chmod(path, 0o600)
-print("seeded")
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        corrupt = "%s.corrupt-%d" % (path, time.time())
+        os.replace(path, corrupt)
+        print("auth.json unreadable, moved to %s" % corrupt, file=sys.stderr)
+        return {}
+
+
+def file_state(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return "%d %d %d" % (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def main():
+    sources = seed_sources()
+    if not sources:
+        return 0
+
+    auth_dir = os.environ.get("AUTH_DIR") or os.path.join(
+        os.environ.get("HOME", "/root"), ".local", "share", "opencode"
+    )
+    path = os.path.join(auth_dir, "auth.json")
+    hash_path = os.path.join(auth_dir, ".auth.json.seed-sha256")
+
+    digest = hashlib.sha256()
+    for source, raw in sources:
+        digest.update(source.encode() + b"\0" + raw + b"\0")
+    seed_hash = digest.hexdigest()
+
+    try:
+        with open(hash_path) as fh:
+            recorded = fh.read().strip()
+        state = file_state(path)
+        if state is not None and recorded == "%s %s" % (seed_hash, state):
+            print("unchanged")
+            return 0
+    except FileNotFoundError:
+        pass
+
+    seed = {}
+    for source, raw in sources:
+        seed.update(decode(source, raw))
+
+    os.makedirs(auth_dir, exist_ok=True)
+    with open(os.path.join(auth_dir, ".auth.json.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        data = load_existing(path)
+        added = sorted(provider for provider in seed if provider not in data)
+        if added:
+            data.update((provider, seed[provider]) for provider in added)
+            write_atomic(path, json.dumps(data))
+        write_atomic(hash_path, "%s %s\n" % (seed_hash, file_state(path)))
+
+    print("seeded %s" % ", ".join(added) if added else "present")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
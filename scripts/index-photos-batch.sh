@@ -1,9 +1,7 @@
 #!/bin/zsh
 
-touch $HOME/reindex.log
-truncate -s0 $HOME/reindex.log
-for year in {2004..2022}; do
-  for month in {01..12}; do
-    echo "cd $HOME/servyy-container/photoprism && docker compose exec -T photoprism photoprism index $year/$month >> $HOME/reindex.log 2>&1" | batch
-  done
-done
+# Queue a full, resumable re-index of all originals; months unchanged since
+# their last successful index are skipped (see index-photos-scheduler.py).
+# The originals folder is taken from $PHOTOPRISM_ORIGINALS when set at queue
+# time, otherwise from the photoprism container's mounts.
+echo "python3 $HOME/servyy-container/scripts/index-photos-scheduler.py ${PHOTOPRISM_ORIGINALS:+--originals ${(q)PHOTOPRISM_ORIGINALS}} ${(q)@} >> $HOME/reindex.log 2>&1" | batch
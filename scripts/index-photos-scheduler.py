@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""Re-index PhotoPrism originals month by month, resumably and in parallel.
+
+Replaces the fixed 2004-2022 loop of index-photos-batch.sh:
+
+* month directories (``YYYY/MM``) are discovered below the originals folder,
+* a month is skipped when its fingerprint (file count, total size, newest
+  mtime) is unchanged since its last successful index,
+* months run with bounded concurrency; no new job starts while the 1-minute
+  load average is above ``--max-load`` (default: CPU count),
+* every finished month is checkpointed to ``--state`` immediately, so an
+  interrupted or failed run resumes with only the missing months,
+* per-month durations are reported and kept in the state file.
+
+The originals folder defaults to $PHOTOPRISM_ORIGINALS, else to the host
+path mounted as the photoprism container's originals folder.
+
+Example:
+    index-photos-scheduler.py --originals /mnt/storagebox/photos --jobs 3
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+MONTH_DIR = re.compile(r"^\d{4}/(0[1-9]|1[0-2])$")
+HOME = os.path.expanduser("~")
+
+
+def container_originals(compose_dir):
+    """Return the host path mounted as the running photoprism container's originals folder, or None."""
+    try:
+        container = subprocess.run(["docker", "compose", "ps", "-q", "photoprism"], cwd=compose_dir,
+                                   capture_output=True, text=True, check=True).stdout.strip()
+        if not container:
+            return None
+        inspect = json.loads(subprocess.run(["docker", "inspect", container],
+                                            capture_output=True, text=True, check=True).stdout)[0]
+    except (OSError, subprocess.CalledProcessError, ValueError, IndexError):
+        return None
+    env = dict(item.split("=", 1) for item in inspect.get("Config", {}).get("Env") or [] if "=" in item)
+    target = env.get("PHOTOPRISM_ORIGINALS_PATH", "/photoprism/originals").rstrip("/")
+    for mount in inspect.get("Mounts") or []:
+        if mount.get("Destination", "").rstrip("/") == target:
+            return mount.get("Source")
+    return None
+
+
+def discover_months(originals, prefix=""):
+    months = []
+    for year in sorted(os.listdir(originals)):
+        year_dir = os.path.join(originals, year)
+        if not os.path.isdir(year_dir):
+            continue
+        for month in sorted(os.listdir(year_dir)):
+            name = "%s/%s" % (year, month)
+            if MONTH_DIR.match(name) and name.startswith(prefix) and os.path.isdir(os.path.join(year_dir, month)):
+                months.append(name)
+    return months
+
+
+def fingerprint(path):
+    """Return ``[files, bytes, newest mtime_ns]`` for everything below ``path``."""
+    files = size = newest = 0
+    for root, dirs, names in os.walk(path):
+        newest = max(newest, os.stat(root).st_mtime_ns)
+        for name in names:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except FileNotFoundError:  # removed while walking
+                continue
+            files += 1
+            size += st.st_size
+            newest = max(newest, st.st_mtime_ns)
+    return [files, size, newest]
+
+
+def load_state(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(path, state):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".photo-index.")
+    with os.fdopen(fd, "w") as fh:
+        json.dump(state, fh, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def index_month(month, compose_dir, log_path):
+    start = time.monotonic()
+    with open(log_path, "a") as log:
+        log.write("=== %s index %s\n" % (time.strftime("%F %T"), month))
+        log.flush()
+        rc = subprocess.call(
+            ["docker", "compose", "exec", "-T", "photoprism", "photoprism", "index", month],
+            cwd=compose_dir, stdout=log, stderr=subprocess.STDOUT,
+        )
+    return rc, time.monotonic() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--originals", default=os.environ.get("PHOTOPRISM_ORIGINALS"),
+                        help="host path of the PhotoPrism originals folder (default: env PHOTOPRISM_ORIGINALS, "
+                             "else the photoprism container's originals mount)")
+    parser.add_argument("--compose-dir", default=os.path.join(HOME, "servyy-container", "photoprism"))
+    parser.add_argument("--state", default=os.path.join(HOME, ".local", "state", "servyy", "photo-index.json"))
+    parser.add_argument("--log", default=os.path.join(HOME, "reindex.log"))
+    parser.add_argument("--jobs", type=int, default=2, help="maximum concurrent index jobs")
+    parser.add_argument("--max-load", type=float, default=float(os.cpu_count() or 1),
+                        help="do not start further jobs while the 1-minute load is above this")
+    parser.add_argument("--only", default="", help="restrict to months starting with this, e.g. 2019 or 2019/0")
+    parser.add_argument("--force", action="store_true", help="ignore fingerprints and index every month")
+    parser.add_argument("--dry-run", action="store_true", help="only list the months that would be indexed")
+    args = parser.parse_args(argv)
+    if not args.originals:
+        args.originals = container_originals(args.compose_dir)
+    if not args.originals:
+        parser.error("cannot find the originals mount of the photoprism container, pass --originals")
+
+    state = load_state(args.state)
+    months = discover_months(args.originals, args.only)
+    pending = []
+    for month in months:
+        fp = fingerprint(os.path.join(args.originals, month))
+        if not args.force and state.get(month, {}).get("fingerprint") == fp:
+            continue
+        pending.append((month, fp))
+    print("%d months to index, %d up to date" % (len(pending), len(months) - len(pending)))
+    if args.dry_run:
+        for month, _ in pending:
+            print(month)
+        return 0
+
+    failed = []
+    running = {}
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        while pending or running:
+            while pending and len(running) < args.jobs and (not running or os.getloadavg()[0] <= args.max_load):
+                month, fp = pending.pop(0)
+                running[pool.submit(index_month, month, args.compose_dir, args.log)] = (month, fp)
+            done, _ = wait(running, timeout=10, return_when=FIRST_COMPLETED)
+            for future in done:
+                month, fp = running.pop(future)
+                try:
+                    rc, duration = future.result()
+                except OSError as e:  # e.g. docker missing: this month failed, keep going
+                    print("%s FAILED: %s" % (month, e))
+                    failed.append(month)
+                    continue
+                if rc == 0:
+                    state[month] = {"fingerprint": fp, "indexed_at": int(time.time()), "duration": round(duration, 1)}
+                    save_state(args.state, state)
+                    print("%s indexed in %.1fs" % (month, duration))
+                else:
+                    failed.append(month)
+                    print("%s FAILED (exit %d) after %.1fs, see %s" % (month, rc, duration, args.log))
+            sys.stdout.flush()
+
+    print("done in %.1fs, %d failed%s" % (time.monotonic() - started, len(failed),
+                                          (": " + " ".join(failed)) if failed else ""))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())